@@ -0,0 +1,345 @@
+# 
+#  Copyright 2023 Telefonica Investigación y Desarrollo, S.A.U
+# 
+#  This file is part of fiware-iotagent-lib
+# 
+#  fiware-iotagent-lib is free software: you can redistribute it and/or
+#  modify it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the License,
+#  or (at your option) any later version.
+# 
+#  fiware-iotagent-lib is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#  See the GNU Affero General Public License for more details.
+# 
+#  You should have received a copy of the GNU Affero General Public
+#  License along with fiware-iotagent-lib.
+#  If not, see http://www.gnu.org/licenses/.
+# 
+
+# Benchmark of legacy_expression_tool.py with synthetic groups and devices. The documents are loaded into a local
+# MongoDB (--mongouri) or into an in-process stand-in (mongomock), and the tool is run over them in commit mode with
+# --metrics, which measures each of its phases
+
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+import argparse
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+
+import pymongo
+
+import legacy_expression_tool as tool
+
+
+# Templates of the synthetic legacy expressions, numbered to get as many distinct expressions as requested
+expression_templates = ['${@value*%d}', '${@temperature/%d}', '${@a+@b+%d}', '${@level*%d/100}', '${@id}:%d${@type}']
+
+
+# Distinct legacy expressions used in the synthetic documents
+def make_expressions(count):
+    return [expression_templates[i % len(expression_templates)] % (i // len(expression_templates)) for i in range(count)]
+
+
+# JEXL translation of a synthetic legacy expression, just to have a translation for each one
+def translate_expression(expression):
+    return expression.replace('${', '').replace('}', '').replace('@', '')
+
+
+# Value of an expression capable field: a legacy expression with the given density, otherwise a JEXL one
+def expression_value(rnd, expressions, density):
+    expression = rnd.choice(expressions)
+    return expression if rnd.random() < density else translate_expression(expression)
+
+
+# Attributes of a group or device, as stored by lib/model/Group.js (attributes) or lib/model/Device.js (active)
+def make_attributes(rnd, expressions, density, count):
+    attributes = []
+    for i in range(count):
+        attribute = {'object_id': 'a' + str(i), 'name': 'attribute' + str(i), 'type': rnd.choice(['Number', 'Text', 'Boolean'])}
+        if rnd.random() < 0.5:
+            attribute['expression'] = expression_value(rnd, expressions, density)
+        if rnd.random() < 0.1:
+            attribute['entity_name'] = expression_value(rnd, expressions, density)
+        if rnd.random() < 0.05:
+            attribute['reverse'] = [{'object_id': 'r' + str(i), 'type': 'Text', 'expression': expression_value(rnd, expressions, density)}]
+        attributes.append(attribute)
+    return attributes
+
+
+# Commands of a group or device
+def make_commands(rnd, expressions, density, count):
+    commands = []
+    for i in range(count):
+        command = {'name': 'command' + str(i), 'type': 'command'}
+        if rnd.random() < 0.3:
+            command['expression'] = expression_value(rnd, expressions, density)
+        commands.append(command)
+    return commands
+
+
+# Service, subservice and expressionLanguage of a synthetic document
+def make_common(rnd, services, subservices):
+    document = {'service': 'service' + str(rnd.randrange(services)), 'subservice': '/subservice' + str(rnd.randrange(subservices))}
+    if rnd.random() < 0.2:
+        document['expressionLanguage'] = rnd.choice(['legacy', 'jexl'])
+    return document
+
+
+# Synthetic group shaped like lib/model/Group.js
+def make_group(rnd, number, expressions, density, services, subservices):
+    group = make_common(rnd, services, subservices)
+    group.update({
+        'resource': '/iot/d',
+        'apikey': 'apikey' + str(number),
+        'type': 'Type' + str(number % 10),
+        'description': 'Synthetic group ' + str(number),
+        'trust': 'trust' + str(number),
+        'cbHost': 'http://orion:1026',
+        'timezone': 'Europe/Madrid',
+        'timestamp': rnd.random() < 0.5,
+        'commands': make_commands(rnd, expressions, density, rnd.randrange(3)),
+        'staticAttributes': [{'name': 'static', 'type': 'Text', 'value': 'value' + str(number)}],
+        'lazy': [],
+        'attributes': make_attributes(rnd, expressions, density, rnd.randrange(1, 10)),
+        'internalAttributes': [],
+        'autoprovision': True,
+        'explicitAttrs': expression_value(rnd, expressions, density) if rnd.random() < 0.1 else rnd.random() < 0.5,
+        'defaultEntityNameConjunction': ':',
+        'ngsiVersion': 'v2',
+        'payloadType': 'iotagent',
+        'useCBflowControl': False,
+        'storeLastMeasure': False
+    })
+    if rnd.random() < 0.3:
+        group['entityNameExp'] = expression_value(rnd, expressions, density)
+    if rnd.random() < 0.1:
+        group['endpoint'] = expression_value(rnd, expressions, density)
+    return group
+
+
+# Synthetic device shaped like lib/model/Device.js
+def make_device(rnd, number, expressions, density, services, subservices):
+    device = make_common(rnd, services, subservices)
+    device.update({
+        'id': 'device' + str(number),
+        'type': 'Type' + str(number % 10),
+        'name': 'urn:ngsi-ld:Type' + str(number % 10) + ':device' + str(number),
+        'lazy': [],
+        'active': make_attributes(rnd, expressions, density, rnd.randrange(1, 10)),
+        'commands': make_commands(rnd, expressions, density, rnd.randrange(3)),
+        'apikey': 'apikey' + str(number % 100),
+        'resource': '/iot/d',
+        'protocol': 'IoTA-UL',
+        'transport': 'HTTP',
+        'staticAttributes': [],
+        'subscriptions': [],
+        'polling': False,
+        'timezone': 'Europe/Madrid',
+        'timestamp': rnd.random() < 0.5,
+        'registrationId': None,
+        'internalId': None,
+        'creationDate': datetime(2024, 1, 1),
+        'internalAttributes': None,
+        'autoprovision': True,
+        'explicitAttrs': expression_value(rnd, expressions, density) if rnd.random() < 0.05 else False,
+        'ngsiVersion': 'v2',
+        'payloadType': 'iotagent',
+        'useCBflowControl': False,
+        'storeLastMeasure': False
+    })
+    if rnd.random() < 0.1:
+        device['endpoint'] = expression_value(rnd, expressions, density)
+    return device
+
+
+# Reset the peak resident memory of the process (see tool.peak_rss), if the OS allows it (Linux). Returns if it was reset
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+# Replication lag of a simulated secondary that applies secondary_rate documents per second: the documents written and
+# not applied yet, in seconds. Used as the lag probe of the commit throttle, as the replication lag of a local database
+# is usually zero
+class SimulatedReplicationLag:
+
+    def __init__(self, secondary_rate):
+        self.secondary_rate = secondary_rate
+        self.start_time = time.monotonic()
+
+    def __call__(self, written_count):
+        applied_count = (time.monotonic() - self.start_time) * self.secondary_rate
+        return max(0, written_count - applied_count) / self.secondary_rate
+
+
+# Run the tool over a collection as the command line does (migrate_collection and report_results), in commit mode with
+# --metrics, so the phases (with the growth of the peak memory in each one) are measured by the tool itself. The output
+# files, checkpoints and metrics report are written to output_dir. The peak memory is reset before starting, once the
+# documents are loaded, so the memory of the tool is its growth from there (the data set of mongomock is in the process)
+def benchmark_collection(client, collection_name, args, translation_path, output_dir):
+    argv = ['--database', args['database'], '--collection', collection_name, '--translation', translation_path, '--commit', '--expressionlanguage', 'jexl',
+            '--metrics', '--statistics', 'subservice', '--batchsize', str(args['batchsize']), '--outputformat', args['outputformat'], '--backupformat', args['backupformat']]
+    for argument in ['pipeline', 'compress']:
+        if args[argument]:
+            argv.append('--' + argument)
+    for argument in ['maxrate', 'maxlatency', 'maxlag']:
+        if args[argument] is not None:
+            argv += ['--' + argument, str(args[argument])]
+    tool_args = dict(vars(tool.create_parser().parse_args(argv)), database=args['database'], collection=collection_name)
+    registry = tool.ExpressionRegistry()
+    registry.load_translation(translation_path)
+    file_prefix = os.path.join(output_dir, collection_name + '_')
+    lag_probe = SimulatedReplicationLag(args['secondaryrate']) if args['secondaryrate'] is not None else None
+
+    peak_reset = reset_peak_rss()
+    start_rss = tool.peak_rss()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        results = tool.migrate_collection(tool_args, client, registry, tool.build_filter(tool_args), file_prefix, lag_probe=lag_probe)
+        tool.report_results(results, tool_args)
+    peak_rss = tool.peak_rss()
+    with open(file_prefix + 'metrics.json') as f:
+        metrics = json.load(f)
+
+    return {
+        'documents': client[args['database']][collection_name].estimated_document_count(),
+        'documents_matched': results['document_count'],
+        'occurrences': results['occurrence_count'],
+        'distinct_expressions': len(registry.expressions),
+        'updated': results['replacement_count'],
+        'failed': results['failed_count'],
+        'commit_backoffs': results['backoff_count'],
+        'output_bytes': sum(os.path.getsize(os.path.join(output_dir, name)) for name in os.listdir(output_dir) if name.startswith(collection_name + '_')),
+        'seconds': metrics['seconds'],
+        'docs_per_second': metrics['docs_per_second'],
+        'start_rss_mb': round(start_rss, 1) if start_rss is not None else None,
+        'peak_rss_mb': round(peak_rss, 1) if peak_rss is not None else None,
+        'tool_rss_mb': round(peak_rss - start_rss, 1) if peak_rss is not None else None,
+        'peak_rss_reset': peak_reset,
+        'phases': metrics['phases'],
+        'query_plan': metrics['query_plan']
+    }
+
+
+def main():
+    # Init time
+    now = datetime.now()
+    init_time = now.strftime("%Y%m%dT%H%M%S_")
+
+    # Create the CLI argunments parser
+    parser = argparse.ArgumentParser(description='Benchmark of the tool to migrate legacy expressions in IoT Agents, with synthetic data')
+    parser.add_argument('--devices', help='Number of synthetic devices', required=False, type=int, default=2000)
+    parser.add_argument('--groups', help='Number of synthetic groups', required=False, type=int, default=200)
+    parser.add_argument('--density', help='Probability of an expression capable field to hold a legacy expression (0 to 1)', required=False, type=float, default=0.3)
+    parser.add_argument('--expressions', help='Number of distinct legacy expressions', required=False, type=int, default=100)
+    parser.add_argument('--services', help='Number of distinct services', required=False, type=int, default=10)
+    parser.add_argument('--subservices', help='Number of distinct subservices', required=False, type=int, default=5)
+    parser.add_argument('--seed', help='Seed of the random generator, so the same data set can be generated again', required=False, type=int, default=1)
+    parser.add_argument('--batchsize', help='Number of documents sent to the database in each bulk write', required=False, type=int, default=500)
+    parser.add_argument('--pipeline', help='Send the next commit batch while the previous one is being written', required=False, action='store_true')
+    parser.add_argument('--maxrate', help='Maximum number of documents per second written in the commit phase', required=False, type=float)
+    parser.add_argument('--maxlatency', help='Write latency of a commit batch (in milliseconds) over which the commit slows down', required=False, type=float)
+    parser.add_argument('--maxlag', help='Replication lag (in seconds) over which the commit slows down', required=False, type=float)
+    parser.add_argument('--secondaryrate', help='Documents per second applied by a simulated secondary, whose lag is used instead of the one of the database', required=False, type=float)
+    parser.add_argument('--outputformat', help='Format of the output files. Possible values: json ndjson', required=False, choices=['json', 'ndjson'], default='json')
+    parser.add_argument('--compress', help='Compress the output files with gzip', required=False, action='store_true')
+    parser.add_argument('--backupformat', help='Format of the backup file. Possible values: json (same as the output files) bson', required=False, choices=['json', 'bson'], default='json')
+    parser.add_argument('--mongouri', help='URI of a local MongoDB to load the data into. If not given, an in-process stand-in (mongomock) is used', required=False)
+    parser.add_argument('--database', help='Database name (its devices and groups collections are dropped)', required=False, default='iotagent_legacy_expression_benchmark')
+    parser.add_argument('--output', help='File where the results are written, in JSON', required=False, default=init_time + 'benchmark.json')
+    args = vars(parser.parse_args())
+
+    if args['devices'] < 0 or args['groups'] < 0 or args['expressions'] < 1 or args['services'] < 1 or args['subservices'] < 1:
+        print('ERROR: Number of devices and groups must not be negative, and number of expressions, services and subservices must be positive')
+        exit(1)
+
+    if not 0 <= args['density'] <= 1:
+        print('ERROR: Density must be between 0 and 1')
+        exit(1)
+
+    if args['batchsize'] < 1:
+        print('ERROR: Batch size must be a positive number')
+        exit(1)
+
+    if any(args[argument] is not None and args[argument] <= 0 for argument in ['maxrate', 'maxlatency', 'maxlag', 'secondaryrate']):
+        print('ERROR: Maximum rate, latency and replication lag and secondary rate must be positive numbers')
+        exit(1)
+
+    if args['maxlag'] is not None and args['secondaryrate'] is None and not args['mongouri']:
+        print('ERROR: Replication lag can only be read from a MongoDB replica set, use --secondaryrate to simulate it')
+        exit(1)
+
+    if args['mongouri']:
+        client = pymongo.MongoClient(args['mongouri'])
+        backend = 'mongodb ' + client.server_info()['version']
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            print('ERROR: mongomock is required to run the benchmark without --mongouri (pip install mongomock)')
+            exit(1)
+        client = mongomock.MongoClient()
+        backend = 'mongomock ' + mongomock.__version__
+        # mongomock cursors cannot explain the query, so the tool reports the query plan as not available
+        def explain(cursor):
+            raise pymongo.errors.OperationFailure('explain is not supported by mongomock')
+        mongomock.collection.Cursor.explain = explain
+        if args['backupformat'] == 'bson':
+            print('ERROR: The bson backup format needs --mongouri, as mongomock cannot return raw BSON documents')
+            exit(1)
+
+    # Synthetic data set: number of documents and generator of each collection
+    rnd = random.Random(args['seed'])
+    expressions = make_expressions(args['expressions'])
+    data = {
+        'groups': (args['groups'], make_group),
+        'devices': (args['devices'], make_device)
+    }
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix=init_time, dir='.') as work_dir:
+        translation_path = os.path.join(work_dir, 'translation.json')
+        with open(translation_path, 'w') as f:
+            json.dump({expression: translate_expression(expression) for expression in expressions}, f)
+        output_dir = os.path.join(work_dir, 'output')
+        os.mkdir(output_dir)
+
+        for collection_name, (count, make_document) in data.items():
+            collection = client[args['database']][collection_name]
+            collection.drop()
+            # The documents are generated and loaded in chunks, so the data set is not kept in memory while the tool runs
+            for start in range(0, count, 1000):
+                collection.insert_many([make_document(rnd, i, expressions, args['density'], args['services'], args['subservices']) for i in range(start, min(start + 1000, count))])
+            results[collection_name] = benchmark_collection(client, collection_name, args, translation_path, output_dir)
+            collection.drop()
+
+            result = results[collection_name]
+            print('INFO: ' + collection_name + ': ' + str(result['documents_matched']) + ' documents in ' + str(result['seconds']) + ' s (' + str(result['docs_per_second']) + ' docs/s), peak RSS ' + str(result['peak_rss_mb']) + ' MB (' + str(result['tool_rss_mb']) + ' MB of the tool)')
+            for phase, phase_result in result['phases'].items():
+                print('INFO: ' + collection_name + ' ' + phase + ': ' + str(phase_result['documents']) + ' documents in ' + str(phase_result['seconds']) + ' s (' + str(phase_result['docs_per_second']) + ' docs/s), ' + str(phase_result['share']) + ' of the time, peak RSS growth ' + str(phase_result['peak_rss_growth_mb']) + ' MB')
+
+    report = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'backend': backend,
+        'python': platform.python_version(),
+        'pymongo': pymongo.version,
+        'platform': platform.platform(),
+        'parameters': {argument: args[argument] for argument in ['devices', 'groups', 'density', 'expressions', 'services', 'subservices', 'seed', 'batchsize', 'pipeline', 'maxrate', 'maxlatency', 'maxlag', 'secondaryrate', 'outputformat', 'compress', 'backupformat']},
+        'results': results
+    }
+    with open(args['output'], 'w') as f:
+        json.dump(report, f, indent=4)
+    print('Benchmark results written to ' + args['output'])
+
+
+if __name__ == '__main__':
+    main()
@@ -20,392 +20,1366 @@
 #  Author by: Miguel Angel Pedraza
 # 
 
-from pymongo import MongoClient
+from pymongo import MongoClient, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
 from bson import json_util, ObjectId
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+import base64
+import bson
+import fnmatch
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
 import json
+import multiprocessing
+import os
 import re
+import sys
+import tempfile
+import time
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import argparse
 
-import pandas as pd
+
+# Error that stops an execution, e.g. invalid arguments or a checkpoint that doesn't match them. The command line prints
+# it as an ERROR and exits with status 1
+class MigrationError(Exception):
+    pass
 
 
 def parse_json(data):
     return json.loads(json_util.dumps(data))
 
-document_replaced_list = []
-find_document_occurrences = []
-found_legacy_expressions = []
-translation_legacy_expressions = []
-document_occurrences_backup = []
-
-debug = False
-commit = False
-replacement_count=0
-
-
-# Init time
-now = datetime.now()
-init_time = now.strftime("%Y%m%dT%H%M%S_")
-
-# Create the CLI argunments parser
-parser = argparse.ArgumentParser(description='Tool to migrate legacy expressions in IoT Agents')
-parser.add_argument('--database', help='Database name', required=True)
-parser.add_argument('--collection', help='Collection name', required=True)
-parser.add_argument('--translation', help='Translation file', required=False)
-parser.add_argument('--debug', help='Debug mode', required=False, action='store_true')
-parser.add_argument('--commit', help='Commit changes to database', required=False, action='store_true')
-parser.add_argument('--mongouri', help='Database connection URI', required=False, default='mongodb://localhost:27017/')
-parser.add_argument('--expressionlanguage', help='How to handle expressionLanguage values. Can be: delete, ignore, jexl or jexlall', required=False, default='ignore')
-parser.add_argument('--statistics', help='Show statistics at the end of the execution. Possible values: service subservice', required=False, default='service')
-parser.add_argument('--regexservice', help='FIWARE service filter', required=False, default='.*')
-parser.add_argument('--regexservicepath', help='FIWARE servicepath filter', required=False, default='.*')
-parser.add_argument('--regexdeviceid', help='Device ID filter', required=False, default='.*')
-parser.add_argument('--regexentitytype', help='Entity type filter', required=False, default='.*')
-parser.add_argument('--service', help='FIWARE service filter', required=False)
-parser.add_argument('--servicepath', help='FIWARE servicepath filter', required=False)
-parser.add_argument('--deviceid', help='Device ID filter', required=False, default='')
-parser.add_argument('--entitytype', help='Entity type filter', required=False)
-args = vars(parser.parse_args())
-
-
-if args['debug']:
-    debug = True
-
-if args['commit'] == True:
-    print('INFO: Running the script in commit mode, this will update the database')
-    commit = True
-
-if args['translation'] != None and args['translation'] != '':
-    with open(args['translation']) as f:
-        translation_legacy_expressions = json.load(f)
-elif (args['translation'] == None or args['translation'] == '') and commit == True:
-    print('ERROR: Translation file is required in commit mode')
-    exit(1)
-
-mongodb_db = args['database']
-mongodb_collection = args['collection']
+
+# Codec options to get the documents as raw BSON, without decoding them
+raw_codec_options = CodecOptions(document_class=RawBSONDocument)
+
+
+# Render a record (which may contain BSON types) as JSON in a single pass. Only NaN and infinite numbers need the
+# extended JSON conversion of json_util.dumps. In bson format, raw documents are rendered as they are, without decoding
+def render_record(record, output_format):
+    if output_format == 'bson':
+        return record.raw if isinstance(record, RawBSONDocument) else bson.encode(record)
+    indent = None if output_format == 'ndjson' else 4
+    try:
+        rendered = json.dumps(record, indent=indent, default=json_util.default, allow_nan=False)
+    except ValueError:
+        rendered = json.dumps(parse_json(record), indent=indent)
+    if output_format == 'ndjson':
+        return rendered
+    # Nest the record one level inside the array
+    return '    ' + rendered.replace('\n', '\n    ')
+
+
+# Writes the records of an output file as soon as they are produced, so they don't have to be kept in memory.
+# The json format keeps the layout of json.dumps(records, indent=4), ndjson writes a record per line and bson writes
+# the BSON documents one after the other (each one starts with its length, as in the files of mongodump).
+# A writer can be resumed from a checkpoint, discarding whatever was written after it
+class ResultWriter:
+
+    def __init__(self, path, output_format='json', compress=False, resume=None):
+        self.output_format = output_format
+        self.path = path
+        self.count = 0
+        if compress:
+            self.path += '.gz'
+        if resume is None:
+            self.raw_file = open(self.path, 'wb')
+        else:
+            self.raw_file = open(self.path, 'r+b')
+            self.raw_file.truncate(resume['offset'])
+            self.raw_file.seek(resume['offset'])
+            self.count = resume['count']
+        self.gzip_file = gzip.GzipFile(fileobj=self.raw_file, mode='wb') if compress else None
+        self.file = self.gzip_file if compress else self.raw_file
+
+    def write(self, record):
+        self.write_rendered(render_record(record, self.output_format))
+
+    # Write a record already rendered with render_record
+    def write_rendered(self, rendered_record):
+        if self.output_format == 'bson':
+            self.file.write(rendered_record)
+        elif self.output_format == 'ndjson':
+            self.file.write((rendered_record + '\n').encode())
+        else:
+            self.file.write((('[\n' if self.count == 0 else ',\n') + rendered_record).encode())
+        self.count += 1
+
+    def flush(self):
+        self.file.flush()
+
+    # Make the records written so far durable and return the position to resume the file from. Compressed files
+    # start a new gzip member, so the file can be truncated at that position
+    def checkpoint(self):
+        if self.gzip_file is not None:
+            self.gzip_file.close()
+        self.raw_file.flush()
+        position = {'offset': self.raw_file.tell(), 'count': self.count}
+        if self.gzip_file is not None:
+            self.gzip_file = gzip.GzipFile(fileobj=self.raw_file, mode='wb')
+            self.file = self.gzip_file
+        return position
+
+    def close(self):
+        if self.raw_file.closed:
+            return
+        if self.output_format == 'json':
+            self.file.write(('\n]' if self.count > 0 else '[]').encode())
+        if self.gzip_file is not None:
+            self.gzip_file.close()
+        self.raw_file.close()
+
+
+# Counts the records of an output file that is not written, so the counts and checkpoints are the same as with a
+# ResultWriter. Used for the backup and replaced documents in projection discovery mode, as they only have some fields
+# of the documents and restoring them would remove the other fields
+class SkippedWriter:
+
+    def __init__(self, resume=None):
+        self.count = resume['count'] if resume is not None else 0
+
+    def write(self, record):
+        self.count += 1
+
+    def write_rendered(self, rendered_record):
+        self.count += 1
+
+    def flush(self):
+        pass
+
+    def checkpoint(self):
+        return {'offset': 0, 'count': self.count}
+
+    def close(self):
+        pass
+
+
+# Keeps the legacy expressions found and their translations in hash tables, so each lookup takes constant time.
+# Expressions are numbered (expressionIndex) in the order they are found for the first time
+class ExpressionRegistry:
+
+    def __init__(self):
+        self.expressions = []
+        self.indexes = {}
+        self.translations = {}
+        self.translation_usage = {}
+        self.duplicated_translations = []
+        self.translation_loaded = False
+
+    # Load a translation file, either a [[legacy, ...], [jexl, ...]] array or a {legacy: jexl} object
+    def load_translation(self, path):
+        with open(path) as f:
+            translation = json.load(f)
+        if isinstance(translation, dict):
+            pairs = list(translation.items())
+        elif isinstance(translation, list) and len(translation) == 2 and all(isinstance(l, list) for l in translation):
+            if len(translation[0]) != len(translation[1]):
+                raise ValueError('the legacy expressions and JEXL expressions arrays have different lengths')
+            pairs = list(zip(translation[0], translation[1]))
+        elif translation == []:
+            pairs = []
+        else:
+            raise ValueError('expected [[legacy, ...], [jexl, ...]] or {legacy: jexl}')
+        for legacy, jexl in pairs:
+            if legacy in self.translations:
+                self.duplicated_translations.append(legacy)
+            else:
+                self.translations[legacy] = jexl
+                self.translation_usage[legacy] = 0
+        self.translation_loaded = self.translation_loaded or translation != []
+
+    # Return the expressionIndex of an expression, registering it if it is the first time it is found
+    def intern(self, expression):
+        index = self.indexes.get(expression)
+        if index is None:
+            index = len(self.expressions)
+            self.indexes[expression] = index
+            self.expressions.append(expression)
+        return index
+
+    # Return the translation of an expression, or None if it is not in the translation file
+    def translate(self, expression):
+        translation = self.translations.get(expression)
+        if translation is not None:
+            self.translation_usage[expression] += 1
+        return translation
+
+    # Add the translations used by other registry (i.e. the one of a worker process)
+    def add_usage(self, translation_usage):
+        for legacy, count in translation_usage.items():
+            if legacy in self.translation_usage:
+                self.translation_usage[legacy] += count
+
+    # New registry with the same translations and no expressions found (i.e. for another collection)
+    def copy_translations(self):
+        registry = ExpressionRegistry()
+        registry.translations = self.translations
+        registry.translation_usage = dict.fromkeys(self.translation_usage, 0)
+        registry.duplicated_translations = self.duplicated_translations
+        registry.translation_loaded = self.translation_loaded
+        return registry
+
+    # State of the registry to be saved in a checkpoint
+    def state(self):
+        return {'expressions': list(self.expressions), 'translation_usage': dict(self.translation_usage)}
+
+    def restore(self, state):
+        for expression in state['expressions']:
+            self.intern(expression)
+        self.add_usage(state['translation_usage'])
+
+    def unused_translations(self):
+        return [legacy for legacy, count in self.translation_usage.items() if count == 0]
+
+
+# Marks a value that doesn't exist in the changes of a document
+_missing = object()
+
+
+# Value of a document at a path in dot notation with array indexes (e.g. attributes.3.expression), or _missing
+def document_path_value(document, path):
+    value = document
+    for part in path.split('.'):
+        if isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        elif isinstance(value, dict) and part in value:
+            value = value[part]
+        else:
+            return _missing
+    return value
+
+
+# Update of the changed paths of a document, as returned by process_document. The update only matches the document if
+# the paths still have their original values, so changes made meanwhile in the database are not overwritten
+def guarded_update(document_id, changes):
+    filter = {'_id': document_id}
+    update = {}
+    for path, original, value in changes:
+        filter[path] = {'$exists': False} if original is _missing else original
+        if value is _missing:
+            update.setdefault('$unset', {})[path] = ''
+        else:
+            update.setdefault('$set', {})[path] = value
+    return UpdateOne(filter, update)
+
+
+# Peak resident memory (MB) of the process, or None if it cannot be measured. On Linux, it is the peak since the last
+# reset (see benchmark.py). It is a single system call, so ExecutionMetrics can read it for every document
+def peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is measured in bytes on macOS and in KB elsewhere
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024 / 1024 if sys.platform == 'darwin' else maxrss / 1024
+
+
+# Metrics of an execution, collected with --metrics: the wall time, documents and growth of the peak memory of each
+# phase, the peak memory and the query plan of the filter. The phases of the scan are interleaved document by document,
+# so their time is split with lap(), which adds the time since the previous lap to a phase. The growth of the peak memory
+# since the previous phase added is taken as the one of the phase added. Without --metrics there is no ExecutionMetrics,
+# so the scan loop only checks that it is None
+class ExecutionMetrics:
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.lap_time = self.start_time
+        self.start_rss = peak_rss()
+        self.rss = self.start_rss
+        self.phases = {}
+        self.query_plan = None
+
+    def add(self, phase, seconds, documents=0):
+        result = self.phases.get(phase)
+        if result is None:
+            result = self.phases[phase] = {'seconds': 0.0, 'documents': 0, 'rss_growth': 0.0}
+        result['seconds'] += seconds
+        result['documents'] += documents
+        if self.rss is not None:
+            rss = peak_rss()
+            result['rss_growth'] += rss - self.rss
+            self.rss = rss
+
+    def start_lap(self):
+        self.lap_time = time.perf_counter()
+
+    def lap(self, phase, documents=0):
+        now = time.perf_counter()
+        self.add(phase, now - self.lap_time, documents)
+        self.lap_time = now
+
+    @contextmanager
+    def measure(self, phase, documents=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start, documents)
+
+    def report(self, counts):
+        seconds = time.perf_counter() - self.start_time
+        phases = {}
+        for phase, result in self.phases.items():
+            phases[phase] = {
+                'seconds': round(result['seconds'], 4),
+                'documents': result['documents'],
+                'docs_per_second': round(result['documents'] / result['seconds'], 1) if result['documents'] > 0 and result['seconds'] > 0 else None,
+                'share': round(result['seconds'] / seconds, 3) if seconds > 0 else None,
+                'peak_rss_growth_mb': round(result['rss_growth'], 1) if self.start_rss is not None else None
+            }
+        memory = peak_rss()
+        return {
+            'seconds': round(seconds, 4),
+            'docs_per_second': round(counts['documents'] / seconds, 1) if seconds > 0 else None,
+            'start_rss_mb': round(self.start_rss, 1) if self.start_rss is not None else None,
+            'peak_rss_mb': round(memory, 1) if memory is not None else None,
+            'counts': counts,
+            'phases': phases,
+            'query_plan': self.query_plan
+        }
+
+
+# Stages of a query plan, from the outermost to the innermost one (i.e. [FETCH, IXSCAN])
+def plan_stages(plan):
+    plan = plan.get('queryPlan', plan)
+    stages = []
+    while isinstance(plan, dict) and 'stage' in plan:
+        stages.append(plan['stage'])
+        plan = plan.get('inputStage', (plan.get('inputStages') or [None])[0])
+    return stages
+
+
+# Query plan of the filter, as it is run by the scan, with its execution statistics. Note that MongoDB runs the whole
+# query to get them
+def explain_query(collection, filter, projection=None):
+    explain = collection.find(filter=filter, projection=projection, sort=[('_id', 1)]).explain()
+    winning_plan = explain.get('queryPlanner', {}).get('winningPlan', {})
+    execution_stats = explain.get('executionStats', {})
+    return {
+        'stages': plan_stages(winning_plan),
+        'nReturned': execution_stats.get('nReturned'),
+        'totalKeysExamined': execution_stats.get('totalKeysExamined'),
+        'totalDocsExamined': execution_stats.get('totalDocsExamined'),
+        'executionTimeMillis': execution_stats.get('executionTimeMillis'),
+        'winningPlan': json.loads(json_util.dumps(winning_plan))
+    }
+
+
+# Progress of a long running stage, printed every interval seconds with the number of documents processed, the rate
+# so far and, when the total is known, the estimated time to finish it
+class ProgressReporter:
+
+    def __init__(self, name, total=None, interval=10):
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.start_time = time.monotonic()
+        self.last_report = self.start_time
+
+    # Count more documents as processed, printing the progress (followed by details) if the interval has elapsed
+    def advance(self, count, details=''):
+        self.done += count
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report(details)
+
+    def report(self, details=''):
+        elapsed = time.monotonic() - self.start_time
+        rate = self.done / elapsed if elapsed > 0 else 0
+        line = 'INFO: ' + self.name + ' progress: ' + str(self.done)
+        if self.total is not None:
+            line += ' of ' + str(self.total) + ' documents (' + format(100 * self.done / self.total if self.total > 0 else 100, '.1f') + '%)'
+        else:
+            line += ' documents'
+        line += ', ' + format(rate, '.1f') + ' docs/s'
+        if self.total is not None and rate > 0:
+            line += ', ETA ' + str(timedelta(seconds=round(max(self.total - self.done, 0) / rate)))
+        print(line + details)
+
+
+# Throttle of the writes to the database, so a commit doesn't hurt the other clients of the database. It is a token
+# bucket refilled at the current rate (documents per second, None if unlimited) that holds up to one batch: each batch
+# waits until there are tokens for all its documents. The rate starts at max_rate and adapts to the load of the
+# database (additive increase, multiplicative decrease): it is halved after a batch whose write took more than
+# max_latency seconds or left a replication lag (as returned by lag_probe for the documents written so far) over
+# max_lag seconds, and grows by a tenth of its initial value after each batch within both limits
+class WriteThrottle:
+
+    def __init__(self, max_rate=None, batch_size=1, max_latency=None, max_lag=None, lag_probe=None, min_rate=1):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.step = max_rate / 10 if max_rate is not None else None
+        self.capacity = batch_size
+        self.max_latency = max_latency
+        self.max_lag = max_lag
+        self.lag_probe = lag_probe
+        self.min_rate = min_rate
+        self.tokens = batch_size
+        self.updated = time.monotonic()
+        self.written_count = 0
+        self.backoff_count = 0
+        self.latency = None
+        self.lag = None
+
+    # Wait until a batch of count documents can be sent at the current rate
+    def acquire(self, count):
+        if self.rate is None:
+            return
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < count:
+            time.sleep((count - self.tokens) / self.rate)
+            self.tokens = count
+            self.updated = time.monotonic()
+        self.tokens -= count
+
+    # Adapt the rate after writing a batch of count documents in latency seconds. Returns True if the rate was lowered
+    def record(self, count, latency):
+        self.written_count += count
+        self.latency = latency
+        if self.lag_probe is not None:
+            self.lag = self.lag_probe(self.written_count)
+        if (self.max_latency is not None and latency > self.max_latency) or (self.max_lag is not None and self.lag is not None and self.lag > self.max_lag):
+            # Without a maximum rate, the back off starts from the rate of the batch just written
+            if self.rate is None:
+                self.rate = count / max(latency, 0.001)
+                self.step = self.rate / 10
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.backoff_count += 1
+            return True
+        if self.rate is not None:
+            self.rate = self.rate + self.step if self.max_rate is None else min(self.max_rate, self.rate + self.step)
+        return False
+
+    # Current state, appended to the progress lines
+    def describe(self):
+        details = ', rate limit ' + (format(self.rate, '.1f') + ' docs/s' if self.rate is not None else 'none')
+        if self.latency is not None:
+            details += ', write latency ' + format(self.latency * 1000, '.0f') + ' ms'
+        if self.lag is not None:
+            details += ', replication lag ' + format(self.lag, '.1f') + ' s'
+        return details
+
+
+# Replication lag of the slowest secondary of the replica set, in seconds (0 if there are no secondaries)
+def replication_lag(client):
+    members = client.admin.command('replSetGetStatus')['members']
+    primary = [member['optimeDate'] for member in members if member['stateStr'] == 'PRIMARY']
+    secondaries = [member['optimeDate'] for member in members if member['stateStr'] == 'SECONDARY']
+    if primary == [] or secondaries == []:
+        return 0
+    return max(0, max((primary[0] - optime).total_seconds() for optime in secondaries))
+
+
+# Throttle of the commit for the arguments (None if it is not throttled). Each of the workers gets its share of the rate.
+# A lag_probe can be given to be used instead of the replication lag of the database (e.g. to simulate it)
+def write_throttle(args, client, workers=1, lag_probe=None):
+    if args['maxrate'] is None and args['maxlatency'] is None and args['maxlag'] is None:
+        return None
+    if args['maxlag'] is not None and lag_probe is None:
+        try:
+            replication_lag(client)
+            lag_probe = lambda written_count: replication_lag(client)
+        except PyMongoError as e:
+            print('WARNING: Replication lag cannot be read, --maxlag is ignored (' + str(e) + ')')
+    return WriteThrottle(args['maxrate'] / workers if args['maxrate'] is not None else None, args['batchsize'],
+                         args['maxlatency'] / 1000 if args['maxlatency'] is not None else None, args['maxlag'], lag_probe)
+
+
+# Accumulates the changes of the documents and sends them to the database in unordered bulk writes,
+# optionally sending the next batch while the previous one is still in flight. A checkpoint can be attached to each
+# batch, which is passed to on_committed once the batch (and all the previous ones) have been written.
+# Documents added with their changes are updated with guarded_update. The ones that changed in the database before
+# being updated are reported and, if refresh is given, read again and retried (up to retries times) with the changes
+# that refresh returns for their current version. Documents added without changes are replaced as a whole.
+# While a retry is pending, the checkpoints are held back (the last one is passed to on_committed once every retry has
+# been written), as resuming from them would skip the documents being retried. The checkpoint of a batch is passed to
+# on_sent before sending it, as the database may write the batch even if it is never acknowledged
+# The batches are delayed by throttle, if given, and the documents added are counted in progress, if given
+class BulkCommitter:
+
+    def __init__(self, collection, batch_size, pipeline=False, name='Commit', on_committed=None, upsert=False, refresh=None, retries=3, throttle=None, progress=None, on_sent=None):
+        self.collection = collection
+        self.throttle = throttle
+        self.progress = progress
+        self.added_count = 0
+        self.unchanged_count = 0
+        self.name = name
+        self.upsert = upsert
+        self.refresh = refresh
+        self.retries = retries
+        self.attempts = {}
+        self.pending_retries = set()
+        self.held_checkpoint = None
+        self.batch_size = batch_size
+        self.on_committed = on_committed
+        self.on_sent = on_sent
+        self.operations = []
+        self.batch_count = 0
+        self.replaced_count = 0
+        self.failed_count = 0
+        self.conflict_count = 0
+        self.write_seconds = 0.0
+        self.executor = ThreadPoolExecutor(max_workers=1) if pipeline else None
+        self.in_flight = None
+
+    # Add a document to the current batch. When the batch is full, it is sent with the checkpoint returned by
+    # get_checkpoint (if given). Documents without changes are not sent, but they are counted as replaced with their
+    # batch, as they are already up to date
+    def add(self, document, get_checkpoint=None, changes=None):
+        self.added_count += 1
+        if changes is None:
+            self.operations.append((ReplaceOne({'_id': document['_id']}, document, upsert=self.upsert), document['_id'], None))
+        elif changes != []:
+            self.operations.append((guarded_update(document['_id'], changes), document['_id'], changes))
+        else:
+            self.unchanged_count += 1
+        if len(self.operations) >= self.batch_size:
+            self.flush(get_checkpoint() if get_checkpoint is not None else None)
+
+    def flush(self, checkpoint=None):
+        if self.operations == [] and self.added_count == 0:
+            return
+        operations = self.operations
+        added_count = self.added_count
+        unchanged_count = self.unchanged_count
+        self.operations = []
+        self.added_count = 0
+        self.unchanged_count = 0
+        if checkpoint is not None and self.on_sent is not None:
+            self.on_sent(checkpoint)
+        if operations == []:
+            # Only documents without changes, there is nothing to write
+            self.wait()
+            self._account((0, 0, []), operations, checkpoint, added_count, unchanged_count)
+            return
+        self.batch_count += 1
+        if self.executor is None:
+            self._account(self._write(self.batch_count, operations), operations, checkpoint, added_count, unchanged_count)
+        else:
+            # Only one batch is kept in flight, so wait for the previous one before sending the next
+            self.wait()
+            self.in_flight = (self.executor.submit(self._write, self.batch_count, operations), operations, checkpoint, added_count, unchanged_count)
+
+    def wait(self):
+        if self.in_flight is not None:
+            in_flight, operations, checkpoint, added_count, unchanged_count = self.in_flight
+            self.in_flight = None
+            self._account(in_flight.result(), operations, checkpoint, added_count, unchanged_count)
+
+    def close(self, checkpoint=None):
+        self.flush(checkpoint)
+        self.wait()
+        # Send the documents being retried
+        while self.operations != []:
+            self.flush()
+            self.wait()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def _account(self, counts, operations, checkpoint, added_count, unchanged_count=0):
+        self.replaced_count += counts[0] + unchanged_count
+        self.failed_count += counts[1]
+        # The retries of the batch have been written (the ones that changed again are retried once more)
+        for operation, document_id, changes in operations:
+            self.pending_retries.discard(bson.encode({'_id': document_id}))
+        for document_id in counts[2]:
+            self._retry(document_id)
+        if checkpoint is not None:
+            self.held_checkpoint = checkpoint
+        if self.held_checkpoint is not None and self.pending_retries == set():
+            if self.on_committed is not None:
+                self.on_committed(self.held_checkpoint)
+            self.held_checkpoint = None
+        if self.progress is not None:
+            self.progress.advance(added_count, self.throttle.describe() if self.throttle is not None else '')
+
+    # Read again a document that changed in the database, adding its current changes to the next batch
+    def _retry(self, document_id):
+        self.conflict_count += 1
+        key = bson.encode({'_id': document_id})
+        self.attempts[key] = self.attempts.get(key, 0) + 1
+        document = self.collection.find_one({'_id': document_id}) if self.refresh is not None and self.attempts[key] <= self.retries else None
+        if document is None:
+            print('ERROR: Document ' + str(document_id) + ' changed in the database while it was being updated, it has not been updated')
+            self.failed_count += 1
+            return
+        changes = self.refresh(document)
+        print('WARNING: Document ' + str(document_id) + ' changed in the database while it was being updated, retrying with ' + str(len(changes)) + ' changes of its current version')
+        if changes != []:
+            self.operations.append((guarded_update(document_id, changes), document_id, changes))
+            self.pending_retries.add(key)
+
+    # Write a batch, returning the number of documents updated and failed and the _id of the documents that didn't
+    # match their guarded update because they changed in the database
+    def _write(self, batch_number, operations):
+        errors = []
+        if self.throttle is not None:
+            self.throttle.acquire(len(operations))
+        start_time = time.monotonic()
+        try:
+            result = self.collection.bulk_write([operation for operation, document_id, changes in operations], ordered=False)
+            matched_count = result.matched_count + result.upserted_count
+        except BulkWriteError as bwe:
+            errors = bwe.details.get('writeErrors', [])
+            matched_count = bwe.details.get('nMatched', 0) + bwe.details.get('nUpserted', 0)
+        latency = time.monotonic() - start_time
+        self.write_seconds += latency
+        if self.throttle is not None and self.throttle.record(len(operations), latency):
+            print('WARNING: ' + self.name + ' batch ' + str(batch_number) + ' overloaded the database, slowing down' + self.throttle.describe())
+        for error in errors:
+            print('ERROR: Failed to update document: ' + str(error['op']['q']['_id']) + ' (' + str(error.get('errmsg')) + ')')
+
+        # Some documents didn't match: find the ones whose changes were not applied
+        conflicts = []
+        if matched_count < len(operations) - len(errors):
+            failed = {error['index'] for error in errors}
+            updates = [(document_id, changes) for index, (operation, document_id, changes) in enumerate(operations) if changes is not None and index not in failed]
+            current = {bson.encode({'_id': document['_id']}): document for document in self.collection.find({'_id': {'$in': [document_id for document_id, changes in updates]}})}
+            for document_id, changes in updates:
+                document = current.get(bson.encode({'_id': document_id}), {})
+                if any(document_path_value(document, path) != value for path, original, value in changes):
+                    conflicts.append(document_id)
+
+        updated_count = len(operations) - len(errors) - len(conflicts)
+        print('INFO: ' + self.name + ' batch ' + str(batch_number) + ': ' + str(updated_count) + ' documents updated, ' + str(len(errors)) + ' failed' + (', ' + str(len(conflicts)) + ' changed in the database' if conflicts != [] else ''))
+        return updated_count, len(errors), conflicts
+
 
 _regex_legacy_expression = '\\${.*(@)'
+legacy_expression_regex = re.compile(_regex_legacy_expression)
+
+
+# Fields in which legacy expressions may be used, as (array field, path inside each element of the array, occurrence
+# type). Fields that are not inside an array have None as array field. Paths follow the MongoDB dot notation, so any
+# array found along the path is traversed. This table drives the query filter, the discovery projection and pipeline and
+# the document walker: a new field only needs a new entry here
+legacy_expression_fields = [
+    ('active', 'expression', 'active.expression'),
+    ('active', 'entity_name', 'active.entity_name'),
+    ('active', 'reverse.expression', 'active.reverse.expression'),
+    ('attributes', 'expression', 'attribute.expression'),                   # groups
+    ('attributes', 'entity_name', 'attribute.entity_name'),                 # groups
+    ('attributes', 'reverse.expression', 'attribute.reverse.expression'),   # groups
+    ('commands', 'expression', 'command.expression'),
+    (None, 'endpoint', 'endpoint'),
+    (None, 'entityNameExp', 'entityNameExp'),
+    (None, 'explicitAttrs', 'explicitAttrs'),
+]
+
+
+# Group the fields table by array field, keeping its order, with the paths split in their parts and the label used in
+# the debug messages. Returns a list of (array field, [(first path part, rest of path parts, type, label)])
+def compile_fields(fields):
+    compiled = []
+    for array_field, field_path, type in fields:
+        if not compiled or compiled[-1][0] != array_field:
+            compiled.append((array_field, []))
+        parts = field_path.split('.')
+        compiled[-1][1].append((parts[0], parts[1:], type, type.split('.')[0]))
+    return compiled
+
 
-# Create a filter for the query
-filter = {
-    '$and':[
-        {'$or':[
-            {'active': {'$elemMatch': {'expression': {'$regex': _regex_legacy_expression}}}},
-            {'active': {'$elemMatch': {'entity_name': {'$regex': _regex_legacy_expression}}}},
-            {'active': {'$elemMatch': {'reverse': {'$elemMatch': {'expression':{'$regex': _regex_legacy_expression}}}}}},
-            {'attributes': {'$elemMatch': {'expression': {'$regex': _regex_legacy_expression}}}},                                # grups
-            {'attributes': {'$elemMatch': {'entity_name': {'$regex': _regex_legacy_expression}}}},                               # grups
-            {'attributes': {'$elemMatch': {'reverse': {'$elemMatch': {'expression':{'$regex': _regex_legacy_expression}}}}}},    # grups
-            {'commands': {'$elemMatch': {'expression': {'$regex': _regex_legacy_expression}}}},
-            {'endpoint': {'$regex': _regex_legacy_expression}},
-            {'entityNameExp': {'$regex': _regex_legacy_expression}},
-            {'explicitAttrs': {'$regex': _regex_legacy_expression}},
+compiled_legacy_expression_fields = compile_fields(legacy_expression_fields)
+
+
+# Conditions matching the documents with a legacy expression in any of the fields of the table
+def legacy_expression_conditions(fields=legacy_expression_fields):
+    conditions = []
+    for array_field, field_path, type in fields:
+        if array_field is None:
+            conditions.append({field_path: {'$regex': _regex_legacy_expression}})
+        else:
+            conditions.append({array_field: {'$elemMatch': {field_path: {'$regex': _regex_legacy_expression}}}})
+    return conditions
+
+
+# Create a filter for the query, from the CLI arguments
+def build_filter(args, debug=False):
+    filter = {
+        '$and':[
+            {'$or': legacy_expression_conditions()}
             ]
-        }
-        ]
-}
-
-if args['expressionlanguage'] == 'delete':
-    filter['$and'][0]['$or'].append({'expressionLanguage':{'$exists': True}})
-    expressionlanguage = 'delete'
-elif args['expressionlanguage'] == 'jexlall':
-    filter['$and'][0]['$or'].append({'expressionLanguage':{'$exists': True}})
-    expressionlanguage = 'jexlall'
-elif args['expressionlanguage'] == 'jexl':
-    expressionlanguage = 'jexl'
-else:
-    expressionlanguage = 'ignore'
-
-if args['regexdeviceid'] != '.*':
-    filter_device_id = args['regexdeviceid']
-    filter['$and'].append({'id': {'$regex': filter_device_id}})
-    if debug:
-        print('Filtering by regex device ID: ' + str(filter_device_id))
+    }
 
-if args['regexentitytype'] != '.*':
-    filter_entity_type = args['regexentitytype']
-    filter['$and'].append({'type': {'$regex': filter_entity_type}})
-    if debug:
-        print('Filtering by regex entity type: ' + str(filter_entity_type))
+    if args['expressionlanguage'] == 'delete' or args['expressionlanguage'] == 'jexlall':
+        filter['$and'][0]['$or'].append({'expressionLanguage':{'$exists': True}})
 
-if args['regexservice'] != '.*':
-    fiware_service = args['regexservice']
-    filter['$and'].append({'service': {'$regex': fiware_service}})
-    if debug:
-        print('Filtering by regex service: ' + str(fiware_service))
+    if args['regexdeviceid'] != '.*':
+        filter_device_id = args['regexdeviceid']
+        filter['$and'].append({'id': {'$regex': filter_device_id}})
+        if debug:
+            print('Filtering by regex device ID: ' + str(filter_device_id))
 
-if args['regexservicepath'] != '.*':
-    fiware_servicepath = args['regexservicepath']
-    filter['$and'].append({'subservice': {'$regex': fiware_servicepath}})
-    if debug:
-        print('Filtering by regex servicepath: ' + fiware_servicepath)
+    if args['regexentitytype'] != '.*':
+        filter_entity_type = args['regexentitytype']
+        filter['$and'].append({'type': {'$regex': filter_entity_type}})
+        if debug:
+            print('Filtering by regex entity type: ' + str(filter_entity_type))
 
-if args['deviceid']:
-    filter['$and'].append({'id': args['deviceid']})
-    if debug:
-        print('Filtering by device ID: ' + str(args['deviceid']))
+    if args['regexservice'] != '.*':
+        fiware_service = args['regexservice']
+        filter['$and'].append({'service': {'$regex': fiware_service}})
+        if debug:
+            print('Filtering by regex service: ' + str(fiware_service))
 
-if args['entitytype']:
-    filter['$and'].append({'type': args['entitytype']})
-    if debug:
-        print('Filtering by entity type: ' + str(args['entitytype']))
+    if args['regexservicepath'] != '.*':
+        fiware_servicepath = args['regexservicepath']
+        filter['$and'].append({'subservice': {'$regex': fiware_servicepath}})
+        if debug:
+            print('Filtering by regex servicepath: ' + fiware_servicepath)
 
-if args['service']:
-    filter['$and'].append({'service': args['service']})
-    if debug:
-        print('Filtering by service: ' + str(args['service']))
+    if args['deviceid']:
+        filter['$and'].append({'id': args['deviceid']})
+        if debug:
+            print('Filtering by device ID: ' + str(args['deviceid']))
 
-if args['servicepath']:
-    filter['$and'].append({'subservice': args['servicepath']})
-    if debug:
-        print('Filtering by servicepath: ' + str(args['servicepath']))  
+    if args['entitytype']:
+        filter['$and'].append({'type': args['entitytype']})
+        if debug:
+            print('Filtering by entity type: ' + str(args['entitytype']))
 
-# Create a client instance of the MongoClient class
-if debug:
-    print('Connected to: '+str(args['mongouri']))
-client = MongoClient(args['mongouri']) # Create a client instance of the MongoClient class
+    if args['service']:
+        filter['$and'].append({'service': args['service']})
+        if debug:
+            print('Filtering by service: ' + str(args['service']))
 
-if debug:
-    print('Running in debug mode')
-    print('MongoDB Query: ' + str(filter))
+    if args['servicepath']:
+        filter['$and'].append({'subservice': args['servicepath']})
+        if debug:
+            print('Filtering by servicepath: ' + str(args['servicepath']))
 
-# Execute find query
-result_cursor = client[mongodb_db][mongodb_collection].find(
-    filter=filter
-)
+    return filter
 
-# Loop through the results
-for occurrence in result_cursor:
 
-    # Append the expression to the backup list
-    document_occurrences_backup.append(parse_json(occurrence))
-    
-    occurrence_id = str(occurrence['_id'])
+# Fields needed to find the legacy expressions of a document, used to fetch only them in discovery mode
+discovery_projection = ['service', 'subservice'] + list(dict.fromkeys(array_field or field_path.split('.')[0] for array_field, field_path, type in legacy_expression_fields)) + ['expressionLanguage']
 
-    # Find the legacy expressions and replace them
-    if 'active' in occurrence:
-        for active in occurrence['active']:
-            if 'expression' in active:
-                if re.search(_regex_legacy_expression, active['expression']):
-                                                            
-                    if active['expression'] not in found_legacy_expressions:
-                        found_legacy_expressions.append(active['expression'])
-                    find_document_occurrences.append({'_id':occurrence_id, 'expression':active['expression'], 'type':'active.expression', 'service':occurrence['service'], 'subservice':occurrence['subservice'], 'expressionIndex':found_legacy_expressions.index(active['expression'])})
-                    if debug:
-                        print ('ocurrence: ' + occurrence_id + ' active: ' + str(active['expression']))
-                    if translation_legacy_expressions!=[]:
-                        # Do the replacement of the legacy expression
-                        if active['expression'] in translation_legacy_expressions[0]:
-                            active['expression'] = translation_legacy_expressions[1][translation_legacy_expressions[0].index(active['expression'])]
-                            if debug:
-                                print(' Replaced expression: "' + active['expression'] + '" in document: ' + occurrence_id)
-                        else:
-                            print('ERROR: Expression not found in translation file: ' + active['expression'] + ' in document: ' + occurrence_id)
-                        
-            if 'entity_name' in active:
-                if re.search(_regex_legacy_expression, active['entity_name']):
-                    if active['entity_name'] not in found_legacy_expressions:
-                        found_legacy_expressions.append(active['entity_name'])
-                    find_document_occurrences.append({'_id':occurrence_id, 'expression':active['entity_name'], 'type':'active.entity_name', 'service':occurrence['service'], 'subservice':occurrence['subservice'], 'expressionIndex':found_legacy_expressions.index(active['entity_name'])})
-                    if debug:
-                        print ('ocurrence: ' + occurrence_id + ' active: ' + str(active['entity_name']))
-                    if translation_legacy_expressions!=[]:
-                        # Do the replacement of the legacy expression
-                        if active['entity_name'] in translation_legacy_expressions[0]:
-                            active['entity_name'] = translation_legacy_expressions[1][translation_legacy_expressions[0].index(active['entity_name'])]
-                            if debug:
-                                print(' Replaced expression: "' + active['entity_name'] + '" in document: ' + occurrence_id)
-                        else:
-                            print('ERROR: Expression not found in translation file: ' + active['entity_name'] + ' in document: ' + occurrence_id)
-
-            if 'reverse' in active:
-                    if 'expression' in active['reverse']:
-                        if re.search(_regex_legacy_expression, active['reverse']['expression']):
-                            if active['reverse']['expression'] not in found_legacy_expressions:
-                                found_legacy_expressions.append(active['reverse']['expression'])
-                            find_document_occurrences.append({'_id':occurrence_id, 'expression':active['reverse']['expression'], 'type':'active.reverse.expression', 'service':occurrence['service'], 'subservice':occurrence['subservice'], 'expressionIndex':found_legacy_expressions.index(active['reverse']['expression'])})
-                            if debug:
-                                print ('ocurrence: ' + occurrence_id + ' active: ' + str(active['reverse']['expression']))
-                            if translation_legacy_expressions!=[]:
-                                # Do the replacement of the legacy expression
-                                if active['reverse']['expression'] in translation_legacy_expressions[0]:
-                                    active['reverse']['expression'] = translation_legacy_expressions[1][translation_legacy_expressions[0].index(active['reverse']['expression'])]
-                                    if debug:
-                                        print(' Replaced expression: "' + active['reverse']['expression'] + '" in document: ' + occurrence_id)
-                                else:
-                                    print('ERROR: Expression not found in translation file: ' + active['reverse']['expression'] + ' in document: ' + occurrence_id)
-
-    if 'attributes' in occurrence:
-        for attribute in occurrence['attributes']:
-            if 'expression' in attribute:
-                if re.search(_regex_legacy_expression, attribute['expression']):
-                    if attribute['expression'] not in found_legacy_expressions:
-                        found_legacy_expressions.append(attribute['expression'])
-                    find_document_occurrences.append({'_id':occurrence_id, 'expression':attribute['expression'], 'type':'attribute.expression', 'service':occurrence['service'], 'subservice':occurrence['subservice'], 'expressionIndex':found_legacy_expressions.index(attribute['expression'])})
-                    if debug:
-                        print ('ocurrence: ' + occurrence_id + ' attribute: ' + str(attribute['expression']))
-                    if translation_legacy_expressions!=[]:
-                        # Do the replacement of the legacy expression
-                        if attribute['expression'] in translation_legacy_expressions[0]:
-                            attribute['expression'] = translation_legacy_expressions[1][translation_legacy_expressions[0].index(attribute['expression'])]
-                            if debug:
-                                print(' Replaced expression: "' + attribute['expression'] + '" in document: ' + occurrence_id)
-                        else:
-                            print('ERROR: Expression not found in translation file: ' + attribute['expression'] + ' in document: ' + occurrence_id)
-
-            if 'entity_name' in attribute:
-                if re.search(_regex_legacy_expression, attribute['entity_name']):
-                    if attribute['entity_name'] not in found_legacy_expressions:
-                        found_legacy_expressions.append(attribute['entity_name'])
-                    find_document_occurrences.append({'_id':occurrence_id, 'expression':attribute['entity_name'], 'type':'attribute.entity_name', 'service':occurrence['service'], 'subservice':occurrence['subservice'], 'expressionIndex':found_legacy_expressions.index(attribute['entity_name'])})
-                    if debug:
-                        print ('ocurrence: ' + occurrence_id + ' attribute: ' + str(attribute['entity_name']))
-                    if translation_legacy_expressions!=[]:
-                        # Do the replacement of the legacy expression
-                        if attribute['entity_name'] in translation_legacy_expressions[0]:
-                            attribute['entity_name'] = translation_legacy_expressions[1][translation_legacy_expressions[0].index(attribute['entity_name'])]
-                            if debug:
-                                print(' Replaced expression: "' + attribute['entity_name'] + '" in document: ' + occurrence_id)
-                        else:
-                            print('ERROR: Expression not found in translation file: ' + attribute['entity_name'] + ' in document: ' + occurrence_id)
-
-            if 'reverse' in attribute:  
-                if 'expression' in attribute['reverse']:
-                    if re.search(_regex_legacy_expression, attribute['reverse']['expression']):
-                        if attribute['reverse']['expression'] not in found_legacy_expressions:
-                            found_legacy_expressions.append(attribute['reverse']['expression'])
-                        find_document_occurrences.append({'_id':occurrence_id, 'expression':attribute['reverse']['expression'], 'type':'attribute.reverse.expression', 'service':occurrence['service'], 'subservice':occurrence['subservice'], 'expressionIndex':found_legacy_expressions.index(attribute['reverse']['expression'])})
-                        if debug:
-                            print ('ocurrence: ' + occurrence_id + ' attribute: ' + str(attribute['reverse']['expression']))
-                        if translation_legacy_expressions!=[]:
-                            # Do the replacement of the legacy expression
-                            if attribute['reverse']['expression'] in translation_legacy_expressions[0]:
-                                attribute['reverse']['expression'] = translation_legacy_expressions[1][translation_legacy_expressions[0].index(attribute['reverse']['expression'])]
-                                if debug:
-                                    print(' Replaced expression: "' + attribute['reverse']['expression'] + '" in document: ' + occurrence_id)
-                            else:
-                                print('ERROR: Expression not found in translation file: ' + attribute['reverse']['expression'] + ' in document: ' + occurrence_id)
-    
-    if 'commands' in occurrence:
-        for command in occurrence['commands']:
-            if 'expression' in command:
-                if re.search(_regex_legacy_expression, command['expression']):
-                    if command['expression'] not in found_legacy_expressions:
-                        found_legacy_expressions.append(command['expression'])
-                    find_document_occurrences.append({'_id':occurrence_id, 'expression':command['expression'], 'type':'command.expression', 'service':occurrence['service'], 'subservice':occurrence['subservice'], 'expressionIndex':found_legacy_expressions.index(command['expression'])})
-                    if debug:
-                        print ('ocurrence: ' + occurrence_id + ' command: ' + str(command['expression']))
-                    if translation_legacy_expressions!=[]:
-                        # Do the replacement of the legacy expression
-                        if command['expression'] in translation_legacy_expressions[0]:
-                            command['expression'] = translation_legacy_expressions[1][translation_legacy_expressions[0].index(command['expression'])]
-                            if debug:
-                                print(' Replaced expression: "' + command['expression'] + '" in document: ' + occurrence_id)
-                        else:
-                            print('ERROR: Expression not found in translation file: ' + command['expression'] + ' in document: ' + occurrence_id)
-            
-    if 'endpoint' in occurrence:
-        if re.search(_regex_legacy_expression, occurrence['endpoint']):
-            if occurrence['endpoint'] not in found_legacy_expressions:
-                found_legacy_expressions.append(occurrence['endpoint'])
-            find_document_occurrences.append({'_id':occurrence_id, 'expression':occurrence['endpoint'], 'type':'endpoint', 'service':occurrence['service'], 'subservice':occurrence['subservice'], 'expressionIndex':found_legacy_expressions.index(occurrence['endpoint'])})
-            if debug:
-                print ('ocurrence: ' + occurrence_id + ' endpoint: ' + str(occurrence['endpoint']))
-            if translation_legacy_expressions!=[]:
-                # Do the replacement of the legacy expression
-                if occurrence['endpoint'] in translation_legacy_expressions[0]:
-                    occurrence['endpoint'] = translation_legacy_expressions[1][translation_legacy_expressions[0].index(occurrence['endpoint'])]
-                    if debug:
-                        print(' Replaced expression: "' + occurrence['endpoint'] + '" in document: ' + occurrence_id)
-                else:
-                    print('ERROR: Expression not found in translation file: ' + occurrence['endpoint'] + ' in document: ' + occurrence_id)
 
-    if 'entityNameExp' in occurrence:
-        if re.search(_regex_legacy_expression, occurrence['entityNameExp']):
-            if occurrence['entityNameExp'] not in found_legacy_expressions:
-                found_legacy_expressions.append(occurrence['entityNameExp'])
-            find_document_occurrences.append({'_id':occurrence_id, 'expression':occurrence['entityNameExp'], 'type':'entityNameExp', 'service':occurrence['service'], 'subservice':occurrence['subservice'], 'expressionIndex':found_legacy_expressions.index(occurrence['entityNameExp'])})
-            if debug:
-                print ('ocurrence: ' + occurrence_id + ' entityNameExp: ' + str(occurrence['entityNameExp']))
-            if translation_legacy_expressions!=[]:
-                # Do the replacement of the legacy expression
-                if occurrence['entityNameExp'] in translation_legacy_expressions[0]:
-                    occurrence['entityNameExp'] = translation_legacy_expressions[1][translation_legacy_expressions[0].index(occurrence['entityNameExp'])]
-                    if debug:
-                        print(' Replaced expression: "' + occurrence['entityNameExp'] + '" in document: ' + occurrence_id)
-                else:
-                    print('ERROR: Expression not found in translation file: ' + occurrence['entityNameExp'] + ' in document: ' + occurrence_id)
+# Aggregation pipeline computing the number of occurrences of each legacy expression by field type, service and
+# subservice inside MongoDB. Besides the candidate values of each document, a marker value (with null type) is kept for
+# every document to count the documents matched by the filter. The candidate values that are arrays (a path traversing
+# an array) are unwound too, and the marker survives that last unwind because its expression is null
+def discovery_pipeline(filter):
+    values = []
+    for array_field, fields in compiled_legacy_expression_fields:
+        candidates = [{'type': type, 'expression': ('$$this.' if array_field else '$') + '.'.join([first] + rest)} for first, rest, type, label in fields]
+        if array_field is None:
+            values.append([candidates])
+        else:
+            values.append({'$map': {
+                'input': {'$cond': [{'$isArray': '$' + array_field}, '$' + array_field, []]},
+                'in': candidates
+            }})
+    values.append([[{'type': None, 'expression': None}]])
 
-    if 'explicitAttrs' in occurrence:
-        if re.search(_regex_legacy_expression, str(occurrence['explicitAttrs'])):       # Note that explicitAttrs can be a boolean value. For that reason, we convert ocurrence['explicitAttrs'] to string, otherwise "TypeError: expected string or bytes-like object" will be raised
-            if occurrence['explicitAttrs'] not in found_legacy_expressions:
-                found_legacy_expressions.append(occurrence['explicitAttrs'])
-            find_document_occurrences.append({'_id':occurrence_id, 'expression':occurrence['explicitAttrs'], 'type':'explicitAttrs', 'service':occurrence['service'], 'subservice':occurrence['subservice'], 'expressionIndex':found_legacy_expressions.index(occurrence['explicitAttrs'])})
-            if debug:
-                print ('ocurrence: ' + occurrence_id + ' explicitAttrs: ' + str(occurrence['explicitAttrs']))
-            if translation_legacy_expressions!=[]:
-                # Do the replacement of the legacy expression
-                if occurrence['explicitAttrs'] in translation_legacy_expressions[0]:
-                    occurrence['explicitAttrs'] = translation_legacy_expressions[1][translation_legacy_expressions[0].index(occurrence['explicitAttrs'])]
-                    if debug:
-                        print(' Replaced expression: "' + occurrence['explicitAttrs'] + '" in document: ' + occurrence_id)
+    return [
+        {'$match': filter},
+        {'$project': {'service': 1, 'subservice': 1, 'values': {'$concatArrays': values}}},
+        {'$unwind': '$values'},
+        {'$unwind': '$values'},
+        {'$unwind': {'path': '$values.expression', 'preserveNullAndEmptyArrays': True}},
+        {'$match': {'$expr': {'$or': [
+            {'$eq': ['$values.type', None]},
+            {'$cond': [
+                {'$eq': [{'$type': '$values.expression'}, 'string']},
+                {'$regexMatch': {'input': '$values.expression', 'regex': _regex_legacy_expression}},
+                False
+            ]}
+        ]}}},
+        {'$group': {
+            '_id': {'expression': '$values.expression', 'type': '$values.type', 'service': '$service', 'subservice': '$subservice'},
+            'count': {'$sum': 1},
+            'first': {'$min': '$_id'}
+        }}
+    ]
+
+
+# Run the discovery aggregation pipeline. Returns the number of documents matched and the occurrence counts, sorted by
+# the first document in which each expression is found
+def discover_with_aggregation(collection, filter):
+    document_count = 0
+    counts = []
+    for group in collection.aggregate(discovery_pipeline(filter), allowDiskUse=True):
+        if group['_id']['type'] is None:
+            document_count += group['count']
+        else:
+            counts.append({'expression': group['_id']['expression'], 'type': group['_id']['type'], 'service': group['_id'].get('service'), 'subservice': group['_id'].get('subservice'), 'count': group['count'], 'first': group['first']})
+    first_found = {}
+    for count in counts:
+        key = id_sort_key(count['first'])
+        if count['expression'] not in first_found or key < first_found[count['expression']]:
+            first_found[count['expression']] = key
+    counts.sort(key=lambda c: (first_found[c['expression']], c['expression'], c['type'], str(c['service']), str(c['subservice'])))
+    return document_count, counts
+
+
+# Yield the (container, key, path) of the values found at the given path parts below container[key], traversing the
+# arrays found on the way and the arrays found at the end of the path, like the MongoDB dot notation does. The path of
+# each value is the one of container[key] followed by the keys and array indexes walked
+def path_values(container, key, parts, path):
+    value = container[key]
+    if isinstance(value, list):
+        if parts:
+            for index, element in enumerate(value):
+                if isinstance(element, dict) and parts[0] in element:
+                    yield from path_values(element, parts[0], parts[1:], path + (index, parts[0]))
+        else:
+            for index in range(len(value)):
+                yield value, index, path + (index,)
+    elif parts:
+        if isinstance(value, dict) and parts[0] in value:
+            yield from path_values(value, parts[0], parts[1:], path + (parts[0],))
+    else:
+        yield container, key, path
+
+
+
+# Legacy expressions of a document, walking the fields table in a single pass over the document. Yields the container of
+# each one (the dict or list holding it, so it can be replaced), its key in the container, its path and its type and
+# label (see legacy_expression_fields)
+def legacy_expression_values(document):
+    for array_field, fields in compiled_legacy_expression_fields:
+        if array_field is None:
+            elements = (document,)
+        else:
+            elements = document.get(array_field)
+            if not isinstance(elements, list):
+                continue
+        for element_index, element in enumerate(elements):
+            if not isinstance(element, dict):
+                continue
+            for field in fields:
+                if field[0] not in element:
+                    continue
+                first, rest, type, label = field
+                value = element[first]
+                # Plain string values (the usual case) are checked in place, only arrays and objects are walked
+                element_path = (first,) if array_field is None else (array_field, element_index, first)
+                if isinstance(value, str):
+                    if rest:
+                        continue
+                    values = ((element, first, element_path),)
+                elif isinstance(value, (list, dict)):
+                    values = path_values(element, first, rest, element_path)
                 else:
-                    print('ERROR: Expression not found in translation file: ' + occurrence['explicitAttrs'] + ' in document: ' + occurrence_id)
-    
+                    continue
+                for container, key, path in values:
+                    expression = container[key]
+                    # Only strings can hold an expression (explicitAttrs, for instance, can also be a boolean value).
+                    # Every legacy expression has an @, which is much cheaper to look for than running the regex
+                    if isinstance(expression, str) and '@' in expression and legacy_expression_regex.search(expression):
+                        yield container, key, path, type, label
+
+
+# Find the legacy expressions of a document and replace them (the document is modified). Returns the list of
+# occurrences found, numbered with the expressionIndex of the given registry. If a changes list is given, the
+# changes made to the document are appended to it as (path, original value, new value), with _missing for the values
+# that didn't exist or have been removed
+def process_document(occurrence, registry, expressionlanguage, debug=False, changes=None):
+    found = []
+
+    occurrence_id = str(occurrence['_id'])
+
+    # Find the legacy expressions and replace them
+    for container, key, path, type, label in legacy_expression_values(occurrence):
+        expression = container[key]
+        found.append({'_id':occurrence_id, 'expression':expression, 'type':type, 'service':occurrence.get('service'), 'subservice':occurrence.get('subservice'), 'expressionIndex':registry.intern(expression)})
+        if debug:
+            print ('ocurrence: ' + occurrence_id + ' ' + label + ': ' + expression)
+        if registry.translation_loaded:
+            # Do the replacement of the legacy expression
+            translation = registry.translate(expression)
+            if translation is not None:
+                container[key] = translation
+                if changes is not None and translation != expression:
+                    changes.append(('.'.join(str(part) for part in path), expression, translation))
+                if debug:
+                    print(' Replaced expression: "' + translation + '" in document: ' + occurrence_id)
+            else:
+                print('ERROR: Expression not found in translation file: ' + expression + ' in document: ' + occurrence_id)
+
     if 'expressionLanguage' in occurrence:
         if expressionlanguage == 'delete':
             if debug:
                 print ('ocurrence: ' + occurrence_id + ' expressionLanguage: ' + str(occurrence['expressionLanguage']))
+            if changes is not None:
+                changes.append(('expressionLanguage', occurrence['expressionLanguage'], _missing))
             del occurrence['expressionLanguage']
         elif expressionlanguage == 'jexl' or expressionlanguage == 'jexlall':
             if debug:
                 print ('ocurrence: ' + occurrence_id + ' expressionLanguage: ' + str(occurrence['expressionLanguage']))
+            if changes is not None and occurrence['expressionLanguage'] != 'jexl':
+                changes.append(('expressionLanguage', occurrence['expressionLanguage'], 'jexl'))
             occurrence['expressionLanguage'] = 'jexl'
     else:
         if expressionlanguage == 'jexl' or expressionlanguage == 'jexlall':    
             if debug:
                 print ('ocurrence: ' + occurrence_id + ' expressionLanguage: ' + 'undefined')
+            if changes is not None:
+                changes.append(('expressionLanguage', _missing, 'jexl'))
             occurrence['expressionLanguage'] = 'jexl'
 
+    return found
+
+
+# Changes needed by the current version of a document (see process_document), used to retry the documents that changed
+# in the database while they were being updated. The registry should be a copy of the one of the scan (see
+# ExpressionRegistry.copy_translations), as the occurrences of the document were already found when it was scanned: its
+# expressions must not be numbered nor its translations counted again
+def document_changes(document, registry, expressionlanguage, debug=False):
+    changes = []
+    process_document(document, registry, expressionlanguage, debug, changes)
+    return changes
+
+
+# Stages of the migration, as generators over documents that can be chained to process the documents lazily, one at a
+# time, whatever their source (a query, a backup or mongodump file or any other iterable of documents):
+#
+#     documents = match_documents(decode_documents(read_documents_file('devices.bson')))
+#     for document, found, changes in write_results(translate_documents(documents, registry, 'jexl'), writer):
+#         ...
+#
+# migrate_collection chains them for each collection, adding the backup, the checkpoints and the commit
+
+# Documents matching the filter, sorted by _id. With raw, they are received as raw BSON documents, without decoding them
+def scan_documents(collection, filter, projection=None, raw=False):
+    if raw:
+        collection = collection.with_options(codec_options=raw_codec_options)
+    yield from collection.find(filter=filter, projection=projection, sort=[('_id', 1)])
+
+
+# Values of a JSON array read from a binary file one at a time, so the whole array is not kept in memory. The text is
+# read in chunks and each value is parsed as soon as it is complete (a value longer than the chunks read so far makes the
+# next read as long as all of them, so it is not parsed again too many times). Objects are converted from extended JSON
+def read_json_array(json_file, chunk_size=65536):
+    decoder = json.JSONDecoder(object_pairs_hook=json_util.object_pairs_hook)
+    text_file = io.TextIOWrapper(json_file, encoding='utf-8')
+    buffer = ''
+    position = 0
+    while True:
+        # Skip the brackets, commas and blanks between values
+        while position < len(buffer) and buffer[position] in '[, \t\r\n':
+            position += 1
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        if position < len(buffer):
+            try:
+                value, position = decoder.raw_decode(buffer, position)
+                yield value
+                continue
+            except json.JSONDecodeError:
+                pass
+        chunk = text_file.read(max(chunk_size, len(buffer) - position))
+        if chunk == '':
+            if position < len(buffer):
+                decoder.raw_decode(buffer, position)
+            return
+        buffer = buffer[position:] + chunk
+        position = 0
+
+
+# Documents of a file, as raw BSON documents. The format is taken from the file extension (.bson, .ndjson or .json,
+# optionally followed by .gz), so it reads the backup files and the files of mongodump. bson files are read without
+# decoding the documents; json and ndjson files are converted from extended JSON. All of them are read one document at
+# a time. The file can be read from an offset of a checkpoint of its ResultWriter
+def read_documents_file(path, offset=0):
+    name = path[:-len('.gz')] if path.endswith('.gz') else path
+    with open(path, 'rb') as raw_file:
+        raw_file.seek(offset)
+        documents_file = gzip.GzipFile(fileobj=raw_file, mode='rb') if path.endswith('.gz') else raw_file
+        if name.endswith('.bson'):
+            yield from bson.decode_file_iter(documents_file, raw_codec_options)
+        elif name.endswith('.ndjson'):
+            for line in documents_file:
+                if line.strip():
+                    yield RawBSONDocument(bson.encode(json_util.loads(line)))
+        else:
+            for document in read_json_array(documents_file):
+                yield RawBSONDocument(bson.encode(document))
+
+
+# Write each document to writer (a ResultWriter) before passing it on, e.g. to back up the raw documents before decoding
+# them
+def write_documents(documents, writer):
+    for document in documents:
+        writer.write(document)
+        yield document
+
+
+# Decode the raw BSON documents, passing the other ones as they are
+def decode_documents(documents, codec_options=CodecOptions()):
+    for document in documents:
+        yield bson.decode(document.raw, codec_options) if isinstance(document, RawBSONDocument) else document
+
+
+# Documents with a legacy expression or, with the delete and jexlall expression languages, an expressionLanguage, as
+# the query of build_filter matches them (without its service, servicepath, device id and entity type filters). It is
+# only needed for documents that don't come from that query, and they must be decoded
+def match_documents(documents, expressionlanguage='ignore'):
+    match_expression_language = expressionlanguage == 'delete' or expressionlanguage == 'jexlall'
+    for document in documents:
+        if (match_expression_language and 'expressionLanguage' in document) or next(legacy_expression_values(document), None) is not None:
+            yield document
 
-    # Update element in the database
-    if commit and translation_legacy_expressions!=[]:
-        client[mongodb_db][mongodb_collection].replace_one(
-            {'_id': occurrence['_id']},
-            occurrence
-        )
-        replacement_count+=1
-
-    # Update element in the list of documents with 
-    document_replaced_list.append(parse_json(occurrence))
-
-# Print the counts
-print ('\nFound ' + str(len(find_document_occurrences)) + ' legacy expressions in ' + str(len(document_replaced_list)) + ' documents')
-if commit:
-    print ('Updated ' + str(replacement_count) + ' documents in the database')
-    
-# write the results to files
-f1 = open(init_time+"legacy_expression_occurrences.json", "w")
-f1.write(json.dumps(find_document_occurrences,indent=4))
-f1.close()
-f2 = open(init_time+"legacy_expressions_list.json", "w")
-f2.write(json.dumps(found_legacy_expressions,indent=4))
-f2.close()
-f3 = open(init_time+"documents_replaced.json", "w")
-f3.write(json.dumps(document_replaced_list,indent=4))
-f3.close()
-f4 = open(init_time+"documents_backup.json", "w")
-f4.write(json.dumps(document_occurrences_backup,indent=4))
-f4.close()
-
-if args['statistics']:
-    
-    # Load data into pandas dataframe
-    df = pd.DataFrame(find_document_occurrences, columns=['_id', 'expression', 'type', 'service', 'subservice', 'expressionIndex'])
+
+# Find the legacy expressions of the documents and replace them (see process_document). Yields each document with the
+# occurrences found and, with track_changes, its changes (None otherwise)
+def translate_documents(documents, registry, expressionlanguage='ignore', debug=False, track_changes=False):
+    for document in documents:
+        changes = [] if track_changes else None
+        found = process_document(document, registry, expressionlanguage, debug, changes)
+        yield document, found, changes
+
+
+# Write the occurrences found and the translated documents of translate_documents to their writers (if given), counting
+# the occurrences by (expression, service, subservice) in statistics_counts (if given)
+def write_results(translations, occurrences_writer=None, replaced_writer=None, statistics_counts=None):
+    for document, found, changes in translations:
+        for found_occurrence in found:
+            if occurrences_writer is not None:
+                occurrences_writer.write(found_occurrence)
+            if statistics_counts is not None:
+                statistics_counts[(found_occurrence['expression'], found_occurrence['service'], found_occurrence['subservice'])] += 1
+        if replaced_writer is not None:
+            replaced_writer.write(document)
+        yield document, found, changes
+
+
+# Add the time taken to produce each item (by the stage and the ones before it, since the previous lap) to a phase of
+# metrics. It is only chained with --metrics, so the stages don't check it
+def measure_stage(items, metrics, phase, documents=1):
+    for item in items:
+        metrics.lap(phase, documents)
+        yield item
+
+
+# Sort key of an _id, following the MongoDB sort order for the types an _id can have
+def id_sort_key(value):
+    if value is None:
+        return [1, '']
+    if isinstance(value, bool):
+        return [9, value]
+    if isinstance(value, (int, float)):
+        return [3, value]
+    if isinstance(value, str):
+        return [4, value]
+    if isinstance(value, ObjectId):
+        return [8, str(value)]
+    if isinstance(value, datetime):
+        return [10, value.isoformat()]
+    return [5, json_util.dumps(value, sort_keys=True)]
+
+
+# Split the documents matching the filter in disjoint partitions (one per worker). Partitions are either ranges of
+# ObjectId _ids, with boundaries taken from a sample of the documents, or groups of services of similar size. The
+# documents are sampled and counted within scope_filter(filter), without the legacy expression conditions, so the
+# collection is not scanned with them before the workers start (partitions don't need to be cut on matching documents)
+def partition_filters(collection, filter, workers, partition='id'):
+    if partition == 'service':
+        services = list(collection.aggregate([
+            {'$match': scope_filter(filter)},
+            {'$group': {'_id': '$service', 'count': {'$sum': 1}}}
+        ]))
+        groups = [[] for i in range(workers)]
+        sizes = [0] * workers
+        # Assign the biggest services first, each one to the smallest group so far
+        for service in sorted(services, key=lambda s: (-s['count'], str(s['_id']))):
+            smallest = sizes.index(min(sizes))
+            groups[smallest].append(service['_id'])
+            sizes[smallest] += service['count']
+        partitions = [{'service': {'$in': group}} for group in groups if group != []]
+        # Without documents in the scope there is a single partition, as with the id partition, so there is always a
+        # worker (and the output files are written, empty)
+        return partitions if partitions != [] else [{}]
+
+    sample = collection.aggregate([
+        {'$match': {'$and': [scope_filter(filter), {'_id': {'$type': 'objectId'}}]}},
+        {'$sample': {'size': 100 * workers}},
+        {'$project': {'_id': 1}}
+    ])
+    ids = sorted(document['_id'] for document in sample)
+    boundaries = []
+    for i in range(1, workers):
+        boundary = ids[len(ids) * i // workers] if ids != [] else None
+        if boundary is not None and (boundaries == [] or boundary > boundaries[-1]):
+            boundaries.append(boundary)
+    filters = []
+    lower = None
+    for upper in boundaries + [None]:
+        if lower is None:
+            # The first partition also takes the documents whose _id is not an ObjectId
+            id_filter = {'$or': [{'_id': {'$not': {'$type': 'objectId'}}}, {'_id': {'$lt': upper}}]} if upper is not None else {}
+        elif upper is None:
+            id_filter = {'_id': {'$gte': lower}}
+        else:
+            id_filter = {'_id': {'$gte': lower, '$lt': upper}}
+        filters.append(id_filter)
+        lower = upper
+    return filters
+
+
+# Fields fingerprinted in the manifest: the ones that can hold a legacy expression and expressionLanguage
+fingerprint_projection = list(dict.fromkeys((array_field + '.' if array_field else '') + field_path for array_field, field_path, type in legacy_expression_fields)) + ['expressionLanguage']
+
+
+# Arguments that must be the same in the executions using a manifest, as they define which documents are fingerprinted
+manifest_arguments = ['database', 'collection', 'expressionlanguage', 'regexservice', 'regexservicepath', 'regexdeviceid', 'regexentitytype', 'service', 'servicepath', 'deviceid', 'entitytype']
+
+
+# Key of a document in the manifest: the hexadecimal string of an ObjectId or the extended JSON of other _id values
+def manifest_key(document_id):
+    return str(document_id) if isinstance(document_id, ObjectId) else json_util.dumps(document_id)
+
+
+# The filter of build_filter without the legacy expression conditions, i.e. the documents of the collection within the
+# service, servicepath, device id and entity type filters
+def scope_filter(filter):
+    return {'$and': filter['$and'][1:]} if len(filter['$and']) > 1 else {}
+
+
+# Newest ObjectId _id of the documents matching the filter, or None if there are none
+def newest_object_id(collection, filter):
+    for document in collection.find({'$and': [filter, {'_id': {'$type': 'objectId'}}]}, projection=['_id'], sort=[('_id', -1)], limit=1):
+        return document['_id']
+    return None
+
+
+# Fingerprint the documents matching the filter whose _id is not an ObjectId newer than high_water_mark, reading only
+# their _id and the fields of fingerprint_projection as raw BSON (the fingerprint is a hash of those bytes, so the
+# documents are not decoded). Returns the fingerprints by manifest_key and the _id of the documents that are new (with
+# an ObjectId newer than the high water mark of the previous manifest, or not in it) or changed since the previous
+# manifest, sorted by _id. Without a previous manifest, no document is returned as new or changed
+def fingerprint_documents(collection, filter, high_water_mark, previous=None):
+    fingerprints = {}
+    changed_ids = []
+    id_filter = {'_id': {'$not': {'$gt': high_water_mark}}} if high_water_mark is not None else {'_id': {'$not': {'$type': 'objectId'}}}
+    raw_collection = collection.with_options(codec_options=raw_codec_options)
+    for document in raw_collection.find({'$and': [filter, id_filter]}, projection=fingerprint_projection):
+        document_id = document['_id']
+        key = manifest_key(document_id)
+        fingerprint = hashlib.blake2b(document.raw, digest_size=8).hexdigest()
+        fingerprints[key] = fingerprint
+        if previous is None:
+            continue
+        previous_high_water_mark = previous['high_water_mark']
+        if isinstance(document_id, ObjectId) and (previous_high_water_mark is None or document_id > previous_high_water_mark):
+            changed_ids.append(document_id)
+        elif previous['fingerprints'].get(key) != fingerprint:
+            changed_ids.append(document_id)
+    changed_ids.sort(key=id_sort_key)
+    return fingerprints, changed_ids
+
+
+# Documents matching the filter among the given _ids (sorted), fetched in batches of batch_size _ids
+def find_by_ids(collection, filter, document_ids, batch_size):
+    for start in range(0, len(document_ids), batch_size):
+        yield from collection.find(filter={'$and': [filter, {'_id': {'$in': document_ids[start:start + batch_size]}}]}, sort=[('_id', 1)])
+
+
+def read_manifest(path):
+    with open(path) as f:
+        manifest = json.load(f)
+    manifest['high_water_mark'] = json_util.loads(json.dumps(manifest['high_water_mark']))
+    return manifest
+
+
+def save_manifest(path, arguments, high_water_mark, fingerprints):
+    manifest = {
+        'arguments': arguments,
+        'high_water_mark': json.loads(json_util.dumps(high_water_mark)),
+        'fingerprints': fingerprints
+    }
+    # Replace the manifest file atomically, so the one of the previous execution is kept if this one is interrupted
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+
+
+# Process the documents of a partition in a worker process. Each document is written to the partial file as a line
+# with its sort key, the occurrences found and the backup and replaced documents already rendered, so the parent
+# process can merge the partial files in the same order as a serial execution
+def scan_partition(args, filter, partition_number, partition_filter, partial_path):
+    debug = args['debug']
+    registry = ExpressionRegistry()
+    if args['translation']:
+        registry.load_translation(args['translation'])
+    client = MongoClient(args['mongouri'])
+    collection = client[args['database']][args['collection']]
+    committer = None
+    if args['commit'] and registry.translation_loaded:
+        name = 'Partition ' + str(partition_number) + ' commit'
+        refresh_registry = registry.copy_translations()
+        committer = BulkCommitter(collection, args['batchsize'], args['pipeline'], name,
+                                  refresh=lambda document: document_changes(document, refresh_registry, args['expressionlanguage'], debug),
+                                  throttle=write_throttle(args, client, args['workers']), progress=ProgressReporter(name, interval=args['progressinterval']))
+    try:
+        with open(partial_path, 'w') as partial_file:
+            projection = discovery_projection if args['discovery'] == 'projection' else None
+            for occurrence in scan_documents(collection, {'$and': [filter, partition_filter]}, projection, args['backupformat'] == 'bson'):
+                if args['backupformat'] == 'bson':
+                    # The raw backup is kept in base64, as the partial file is a text file
+                    backup = base64.b64encode(occurrence.raw).decode()
+                    occurrence = bson.decode(occurrence.raw, collection.codec_options)
+                else:
+                    backup = render_record(occurrence, args['outputformat'])
+                changes = [] if committer is not None else None
+                found = process_document(occurrence, registry, args['expressionlanguage'], debug, changes)
+                if committer is not None:
+                    committer.add(occurrence, changes=changes)
+                replaced = render_record(occurrence, args['outputformat'])
+                partial_file.write(json.dumps([id_sort_key(occurrence['_id']), found, backup, replaced]) + '\n')
+    finally:
+        if committer is not None:
+            committer.close()
+        client.close()
+    return {
+        'translation_usage': registry.translation_usage,
+        'replaced_count': committer.replaced_count if committer is not None else 0,
+        'failed_count': committer.failed_count if committer is not None else 0,
+        'conflict_count': committer.conflict_count if committer is not None else 0,
+        'batch_count': committer.batch_count if committer is not None else 0,
+        'backoff_count': committer.throttle.backoff_count if committer is not None and committer.throttle is not None else 0
+    }
+
+
+def read_partial_file(partial_path):
+    with open(partial_path) as partial_file:
+        for line in partial_file:
+            yield json.loads(line)
+
+
+# Decoded BSON value in a form that compares equal for the same value, except for the size of the integers (int32 and
+# Int64 are the same), which extended JSON doesn't keep. Keys keep their order, and booleans and NaN are compared as
+# BSON does
+def comparable_value(value):
+    if isinstance(value, dict):
+        return ('document', [(key, comparable_value(item)) for key, item in value.items()])
+    if isinstance(value, list):
+        return ('array', [comparable_value(item) for item in value])
+    if isinstance(value, int) and not isinstance(value, bool):
+        return ('int', int(value))
+    if isinstance(value, float):
+        return ('float', repr(value))
+    return (type(value).__name__, value)
+
+
+# Compare the documents of a backup with the ones in the database, byte by byte or, without exact (for the backups in
+# extended JSON), with comparable_value. Returns the number of documents that are identical, different and missing in
+# the database. With report, the documents that are not identical are printed
+def verify_backup_documents(collection, documents, report=False, exact=True):
+    def key(document):
+        return bson.encode({'_id': document['_id']})
+
+    def same(raw, document):
+        if exact:
+            return raw == document.raw
+        return raw is not None and comparable_value(bson.decode(raw)) == comparable_value(bson.decode(document.raw))
+
+    current = {key(document): document.raw for document in collection.with_options(codec_options=raw_codec_options).find({'_id': {'$in': [document['_id'] for document in documents]}})}
+    identical, different, missing = 0, 0, 0
+    for document in documents:
+        raw = current.get(key(document))
+        if same(raw, document):
+            identical += 1
+        elif raw is None:
+            missing += 1
+            if report:
+                print('Document missing in the database: ' + str(document['_id']))
+        else:
+            different += 1
+            if report:
+                print('Document different in the database: ' + str(document['_id']))
+    return identical, different, missing
+
+
+# Restore the documents of a backup file into the collection, replacing them in batches (the documents that no longer
+# exist are inserted again). Each batch is read back and compared with the backup once it is written (byte by byte only
+# for bson files, see verify_backup_documents). Without commit, the backup is only compared with the database. Returns
+# the number of documents in the backup and the totals of verify_backup_documents
+def restore_backup(collection, path, batch_size, commit, pipeline=False, debug=False, throttle=None, progress=None):
+    totals = [0, 0, 0]
+    pending = []
+    exact = (path[:-len('.gz')] if path.endswith('.gz') else path).endswith('.bson')
+
+    def verify(documents):
+        # After restoring them, the documents that differ are always reported
+        counts = verify_backup_documents(collection, documents, debug or commit, exact)
+        for i, count in enumerate(counts):
+            totals[i] += count
+        if commit and counts[0] != len(documents):
+            print('ERROR: ' + str(len(documents) - counts[0]) + ' documents of the batch differ from the backup after restoring them')
+
+    # The documents of each batch are passed as its checkpoint, so they are verified once the batch is written
+    def take_pending():
+        documents = pending[:]
+        pending.clear()
+        return documents
+
+    committer = BulkCommitter(collection, batch_size, pipeline, 'Restore', on_committed=verify, upsert=True, throttle=throttle, progress=progress) if commit else None
+    document_count = 0
+    for document in read_documents_file(path):
+        document_count += 1
+        pending.append(document)
+        if committer is not None:
+            committer.add(document, take_pending)
+        elif len(pending) >= batch_size:
+            verify(take_pending())
+    if committer is not None:
+        committer.close(take_pending())
+    elif pending != []:
+        verify(take_pending())
+    return document_count, totals[0], totals[1], totals[2]
+
+
+# Plain text version of the statistics table printed with pandas: one row per expression and one column per service
+# (and subservice), with the totals in the All row and column
+def statistics_table(statistics_occurrences, statistics):
+    levels = ['service', 'subservice'] if statistics == 'subservice' else ['service']
+    counts = Counter()
+    for expression, service, subservice, count in statistics_occurrences:
+        counts[(expression, (service, subservice)[:len(levels)])] += count
+    expressions = sorted({expression for expression, column in counts}, key=str)
+    columns = sorted({column for expression, column in counts}, key=lambda column: [str(value) for value in column])
+
+    rows = [[expression] + [counts[(expression, column)] for column in columns] for expression in expressions]
+    for row in rows:
+        row.append(sum(row[1:]))
+    rows.append(['All'] + [sum(counts[(expression, column)] for expression in expressions) for column in columns] + [sum(counts.values())])
+
+    table = [[level] + [str(column[i]) for column in columns] + ['All' if i == 0 else ''] for i, level in enumerate(levels)]
+    table.append(['expression'] + [''] * (len(columns) + 1))
+    table += [[str(value) for value in row] for row in rows]
+    widths = [max(len(line[i]) for line in table) for i in range(len(table[0]))]
+    return '\n'.join((line[0].ljust(widths[0]) + ''.join(' ' + value.rjust(width) for value, width in zip(line[1:], widths[1:]))).rstrip() for line in table)
+
+
+# Print the number of occurrences of each expression by service (and subservice). Each row of statistics_occurrences
+# contains an expression, service, subservice and number of occurrences. pandas is only imported here, so executions
+# without statistics don't load it, and the table is printed as plain text when it is not installed
+def print_statistics(statistics_occurrences, statistics):
+    try:
+        import pandas as pd
+    except ImportError:
+        print(statistics_table(statistics_occurrences, statistics))
+        return
+
+    # Load data into pandas dataframe (the number of occurrences is kept in the _id column, as the table counted the
+    # _id of the occurrences)
+    df = pd.DataFrame(statistics_occurrences, columns=['expression', 'service', 'subservice', '_id'])
 
     # Configure pandas to display all data
     pd.set_option('expand_frame_repr', False)
@@ -414,10 +1388,607 @@ if args['statistics']:
 
     table_collums = ['service']
 
-    if args['statistics'] == 'subservice':
+    if statistics == 'subservice':
         table_collums.append('subservice')
 
-    new = df.pivot_table(index='expression', columns=table_collums, values=['_id'], aggfunc='count', fill_value=0, margins=True)
-    
+    new = df.pivot_table(index='expression', columns=table_collums, values=['_id'], aggfunc='sum', fill_value=0, margins=True)
+
     # Display all data
     print(new)
+
+
+# Arguments that must be the same to resume an execution from a checkpoint
+checkpoint_arguments = ['database', 'collection', 'translation', 'commit', 'expressionlanguage', 'outputformat', 'backupformat', 'compress', 'discovery',
+                        'regexservice', 'regexservicepath', 'regexdeviceid', 'regexentitytype', 'service', 'servicepath', 'deviceid', 'entitytype']
+
+
+# Rows for print_statistics from the statistics counters
+def statistics_rows(statistics_counts):
+    return [(expression, service, subservice, count) for (expression, service, subservice), count in statistics_counts.items()]
+
+
+# Names given in the arguments, where glob patterns (e.g. iot_*) are replaced by the names returned by list_names that
+# match them, in order and without duplicates. System databases and collections only match their own name
+def match_names(patterns, list_names, system_names):
+    names = []
+    existing = None
+    for pattern in patterns:
+        if any(character in pattern for character in '*?['):
+            if existing is None:
+                existing = sorted(name for name in list_names() if not system_names(name))
+            matched = fnmatch.filter(existing, pattern)
+        else:
+            matched = [pattern]
+        names.extend(name for name in matched if name not in names)
+    return names
+
+
+# Collections to migrate, as (database, collection) pairs: each collection given (or matching a pattern) in each
+# database given (or matching a pattern)
+def expand_targets(client, databases, collections):
+    targets = []
+    for database in match_names(databases, client.list_database_names, lambda name: name in ['admin', 'config', 'local']):
+        for collection in match_names(collections, client[database].list_collection_names, lambda name: name.startswith('system.')):
+            targets.append((database, collection))
+    return targets
+
+
+# Look for the legacy expressions of the collection args['collection'] of the database args['database'] and, in
+# commit mode, replace them. The output files are named with file_prefix and the expressions found are added to registry.
+# Returns the counts and statistics of the collection, which are printed with report_results, or None if the execution
+# of the checkpoint to resume already finished. Raises MigrationError if the checkpoint or the manifest don't match the
+# arguments. lag_probe is passed to write_throttle (it is not used by the workers)
+def migrate_collection(args, client, registry, filter, file_prefix, commit_name='Commit', lag_probe=None):
+    debug = args['debug']
+    commit = args['commit']
+    expressionlanguage = args['expressionlanguage']
+    mongodb_db = args['database']
+    mongodb_collection = args['collection']
+    init_time = file_prefix
+    metrics = ExecutionMetrics() if args['metrics'] else None
+    replacement_count = 0
+    conflict_count = 0
+    failed_count = 0
+    batch_count = 0
+    backoff_count = 0
+    statistics_counts = Counter()
+    checkpoint = None
+    last_id = None
+    unacknowledged_ids = []
+
+    # Continue a previous execution from its last checkpoint, with the same arguments and output files
+    if args['resume']:
+        with open(args['resume']) as f:
+            checkpoint = json.load(f)
+        if checkpoint['finished']:
+            print('INFO: The execution of checkpoint ' + args['resume'] + ' already finished, nothing to resume')
+            return None
+        mismatched_arguments = [argument for argument in checkpoint_arguments if checkpoint['arguments'][argument] != args[argument]]
+        if mismatched_arguments != []:
+            raise MigrationError('Arguments differ from the ones of the checkpoint: ' + ', '.join(mismatched_arguments))
+        init_time = checkpoint['init_time']
+        registry.restore(checkpoint['registry'])
+        for expression, service, subservice, count in checkpoint['statistics']:
+            statistics_counts[(expression, service, subservice)] = count
+        last_id = json_util.loads(json.dumps(checkpoint['last_id']))
+        if last_id is not None:
+            filter = {'$and': [filter, {'_id': {'$gt': last_id}}]}
+        print('INFO: Resuming from checkpoint ' + args['resume'] + ' after ' + str(checkpoint['files']['documents_backup']['count']) + ' documents')
+
+    # With the manifest of a previous execution, only the documents new or changed since then are processed
+    previous_manifest = None
+    if args['manifest'] and os.path.exists(args['manifest']):
+        previous_manifest = read_manifest(args['manifest'])
+        mismatched_arguments = [argument for argument in manifest_arguments if previous_manifest['arguments'][argument] != args[argument]]
+        if mismatched_arguments != []:
+            raise MigrationError('Arguments differ from the ones of the manifest: ' + ', '.join(mismatched_arguments))
+
+    # The extension of the output files is their format (json, ndjson or bson)
+    def output_file_name(name, output_format=None):
+        return init_time + name + '.' + (output_format or args['outputformat'])
+
+    def results(document_count, occurrence_count):
+        return {
+            'database': mongodb_db,
+            'collection': mongodb_collection,
+            'file_prefix': init_time,
+            'registry': registry,
+            'statistics_counts': statistics_counts,
+            'document_count': document_count,
+            'occurrence_count': occurrence_count,
+            'replacement_count': replacement_count,
+            'conflict_count': conflict_count,
+            'failed_count': failed_count,
+            'batch_count': batch_count,
+            'backoff_count': backoff_count,
+            'metrics': metrics
+        }
+
+    # The query plan of the filter is explained before the scan, as explaining it runs the query too
+    if metrics is not None:
+        with metrics.measure('explain'):
+            try:
+                metrics.query_plan = explain_query(client[mongodb_db][mongodb_collection], filter, discovery_projection if args['discovery'] == 'projection' else None)
+                print('INFO: Query plan: ' + ' > '.join(reversed(metrics.query_plan['stages'])) + ', ' + str(metrics.query_plan['totalDocsExamined']) + ' documents and ' + str(metrics.query_plan['totalKeysExamined']) + ' index keys examined to return ' + str(metrics.query_plan['nReturned']) + ' documents in ' + str(metrics.query_plan['executionTimeMillis']) + ' ms')
+            except PyMongoError as e:
+                print('WARNING: Query plan cannot be explained (' + str(e) + ')')
+
+    # Count the legacy expressions inside MongoDB, so only the counts are transferred
+    if args['discovery'] == 'aggregation':
+        with metrics.measure('discovery') if metrics is not None else nullcontext():
+            document_count, counts = discover_with_aggregation(client[mongodb_db][mongodb_collection], filter)
+        counts_writer = ResultWriter(output_file_name('legacy_expression_counts'), args['outputformat'], args['compress'])
+        try:
+            with metrics.measure('serialization', len(counts)) if metrics is not None else nullcontext():
+                for count in counts:
+                    counts_writer.write({'expression': count['expression'], 'type': count['type'], 'service': count['service'], 'subservice': count['subservice'], 'count': count['count'], 'expressionIndex': registry.intern(count['expression'])})
+                    statistics_counts[(count['expression'], count['service'], count['subservice'])] += count['count']
+        finally:
+            counts_writer.close()
+        return results(document_count, sum(count['count'] for count in counts))
+
+    # The batches sent after the last one acknowledged may have been written to the database or not. Their documents are
+    # the ones of the backup after its committed position: they are read again from the database to send their changes
+    # again (the ones written have none), but they are not written to the output files, as they already are
+    if checkpoint is not None and commit:
+        committed_backup = checkpoint.get('committed_backup', checkpoint['files']['documents_backup'])
+        unacknowledged_count = checkpoint['files']['documents_backup']['count'] - committed_backup['count']
+        if unacknowledged_count > 0:
+            backup_path = output_file_name('documents_backup', 'bson' if args['backupformat'] == 'bson' else None) + ('.gz' if args['compress'] else '')
+            unacknowledged_ids = [document['_id'] for document in itertools.islice(read_documents_file(backup_path, committed_backup['offset']), unacknowledged_count)]
+
+    # Open the output files, so the results are written while the documents are processed
+    def open_writer(name, output_format=None):
+        return ResultWriter(output_file_name(name, output_format), output_format or args['outputformat'], args['compress'], checkpoint['files'][name] if checkpoint is not None else None)
+
+    occurrences_writer = open_writer('legacy_expression_occurrences')
+    if args['discovery'] == 'projection':
+        # The documents only have the projected fields, so they are not written
+        replaced_writer = SkippedWriter(checkpoint['files']['documents_replaced'] if checkpoint is not None else None)
+        backup_writer = SkippedWriter(checkpoint['files']['documents_backup'] if checkpoint is not None else None)
+    else:
+        replaced_writer = open_writer('documents_replaced')
+        backup_writer = open_writer('documents_backup', 'bson' if args['backupformat'] == 'bson' else None)
+    writers = [occurrences_writer, replaced_writer, backup_writer]
+
+    # Write an occurrence to the occurrences file, counting it for the statistics
+    def add_occurrence(found_occurrence):
+        occurrences_writer.write(found_occurrence)
+        statistics_counts[(found_occurrence['expression'], found_occurrence['service'], found_occurrence['subservice'])] += 1
+
+    # Checkpoints record the position of the output files, the registry and the statistics after the last document
+    # processed (last_id), so the execution can be resumed from it with --resume. In commit mode, the checkpoint of each
+    # batch is saved before sending it, so the results of the documents that may have been written to the database are
+    # never discarded, and the counts of the commit are saved once it has been written, with the position of the backup
+    # after the last document written (committed_backup)
+    checkpoint_path = args['resume'] if args['resume'] else init_time + 'checkpoint.json'
+    saved_checkpoint = {
+        'committed_backup': checkpoint.get('committed_backup', checkpoint['files']['documents_backup']) if checkpoint is not None else {'offset': 0, 'count': 0},
+        'replaced_count': checkpoint['replaced_count'] if checkpoint is not None else 0,
+        'failed_count': checkpoint['failed_count'] if checkpoint is not None else 0,
+        'conflict_count': checkpoint['conflict_count'] if checkpoint is not None else 0,
+        'batch_count': checkpoint['batch_count'] if checkpoint is not None else 0
+    }
+
+    def get_checkpoint():
+        return {
+            'last_id': json.loads(json_util.dumps(last_id)),
+            'files': {
+                'legacy_expression_occurrences': occurrences_writer.checkpoint(),
+                'documents_replaced': replaced_writer.checkpoint(),
+                'documents_backup': backup_writer.checkpoint()
+            },
+            'registry': registry.state(),
+            'statistics': [[expression, service, subservice, count] for (expression, service, subservice), count in statistics_counts.items()]
+        }
+
+    def write_checkpoint(finished=False):
+        checkpoint = dict(saved_checkpoint)
+        checkpoint['init_time'] = init_time
+        checkpoint['arguments'] = {argument: args[argument] for argument in checkpoint_arguments}
+        checkpoint['finished'] = finished
+        # Replace the checkpoint file atomically, so a valid checkpoint always exists
+        with open(checkpoint_path + '.tmp', 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+    # Save the checkpoint of the documents processed (in commit mode, before sending them to the database)
+    def save_checkpoint(checkpoint, finished=False):
+        saved_checkpoint.update(checkpoint)
+        if committer is None or finished:
+            saved_checkpoint['committed_backup'] = checkpoint['files']['documents_backup']
+        write_checkpoint(finished)
+
+    # Save the counts of the commit once the documents until the checkpoint have been written to the database
+    def save_committed(checkpoint):
+        saved_checkpoint['committed_backup'] = checkpoint['files']['documents_backup']
+        saved_checkpoint['replaced_count'] = committer.replaced_count
+        saved_checkpoint['failed_count'] = committer.failed_count
+        saved_checkpoint['conflict_count'] = committer.conflict_count
+        saved_checkpoint['batch_count'] = committer.batch_count
+        write_checkpoint()
+
+    # Make the results written so far durable
+    def flush_writers():
+        if backup_writer.count % args['batchsize'] == 0:
+            for writer in writers:
+                writer.flush()
+
+    committer = None
+    try:
+        if args['workers'] == 1:
+            collection = client[mongodb_db][mongodb_collection]
+
+            # The progress is counted over the documents that are left to scan. They are only counted with --progress,
+            # as counting them runs the query once more (without throttling): otherwise there is no total nor ETA. With
+            # a manifest, they are the documents new or changed
+            progress_total = collection.count_documents(filter) if args['progress'] and previous_manifest is None else None
+            if commit and registry.translation_loaded:
+                refresh_registry = registry.copy_translations()
+                committer = BulkCommitter(collection, args['batchsize'], args['pipeline'], commit_name, on_committed=save_committed, on_sent=save_checkpoint,
+                                          refresh=lambda document: document_changes(document, refresh_registry, expressionlanguage, debug),
+                                          throttle=write_throttle(args, client, lag_probe=lag_probe),
+                                          progress=ProgressReporter(commit_name, progress_total, args['progressinterval']))
+                if checkpoint is not None:
+                    committer.replaced_count = checkpoint['replaced_count']
+                    committer.failed_count = checkpoint['failed_count']
+                    committer.conflict_count = checkpoint['conflict_count']
+                    committer.batch_count = checkpoint['batch_count']
+            if checkpoint is None:
+                save_checkpoint(get_checkpoint())
+
+            # Send again the changes of the documents of the batches not acknowledged before the interruption. Their
+            # batches have no checkpoint, so they are sent again if the execution is interrupted before the next one
+            if unacknowledged_ids != [] and committer is not None:
+                print('INFO: Sending again the ' + str(len(unacknowledged_ids)) + ' documents of the batches not acknowledged before the interruption')
+                for document in find_by_ids(collection, {}, unacknowledged_ids, args['batchsize']):
+                    committer.add(document, changes=document_changes(document, refresh_registry, expressionlanguage, debug))
+
+            # The documents are fingerprinted before they are scanned, so the ones changed meanwhile are processed again
+            # in the next execution with the manifest
+            if args['manifest']:
+                with metrics.measure('fingerprint') if metrics is not None else nullcontext():
+                    high_water_mark = newest_object_id(collection, scope_filter(filter))
+                    fingerprints, changed_ids = fingerprint_documents(collection, scope_filter(filter), high_water_mark, previous_manifest)
+                if metrics is not None:
+                    metrics.phases['fingerprint']['documents'] = len(fingerprints)
+                if previous_manifest is not None:
+                    removed_count = sum(1 for key in previous_manifest['fingerprints'] if key not in fingerprints)
+                    print('INFO: ' + str(len(changed_ids)) + ' documents new or changed and ' + str(removed_count) + ' removed since the execution of the manifest, out of ' + str(len(fingerprints)))
+                    if args['progress']:
+                        progress_total = len(changed_ids)
+                        if committer is not None:
+                            committer.progress.total = progress_total
+
+            # Execute find query (sorted by _id, so the output doesn't depend on the number of workers). With the bson
+            # backup format, the documents are received as raw BSON, so they are written to the backup as they are
+            if previous_manifest is not None:
+                find_collection = collection.with_options(codec_options=raw_codec_options) if args['backupformat'] == 'bson' else collection
+                documents = find_by_ids(find_collection, filter, changed_ids, args['batchsize'])
+            else:
+                documents = scan_documents(collection, filter, discovery_projection if args['discovery'] == 'projection' else None, args['backupformat'] == 'bson')
+
+            progress = None
+            if args['progress']:
+                progress = ProgressReporter('Scan', progress_total, args['progressinterval'])
+
+            # Chain the stages: back up each document as it is received, find its legacy expressions and replace them
+            # (in commit mode, keeping its changes to update only the changed fields) and write the results. With
+            # metrics, the time of each stage is added to its phase
+            def measured(items, phase, documents=1):
+                return measure_stage(items, metrics, phase, documents) if metrics is not None else items
+
+            documents = write_documents(measured(documents, 'query'), backup_writer)
+            if args['backupformat'] == 'bson':
+                documents = decode_documents(documents, collection.codec_options)
+            translations = translate_documents(measured(documents, 'serialization', 0), registry, expressionlanguage, debug, committer is not None)
+            translations = write_results(measured(translations, 'transform'), occurrences_writer, replaced_writer, statistics_counts)
+
+            if metrics is not None:
+                metrics.start_lap()
+            for occurrence, found, changes in measured(translations, 'serialization'):
+                last_id = occurrence['_id']
+
+                # Update element in the database (the changes are sent with the next batch)
+                if committer is not None:
+                    committer.add(occurrence, get_checkpoint, changes)
+                elif backup_writer.count % args['batchsize'] == 0:
+                    save_checkpoint(get_checkpoint())
+                if metrics is not None:
+                    metrics.lap('commit' if committer is not None else 'checkpoint', 1)
+                if progress is not None:
+                    progress.advance(1)
+
+            # Send the pending replacements to the database
+            if committer is not None:
+                with metrics.measure('commit') if metrics is not None else nullcontext():
+                    committer.close(get_checkpoint())
+                if metrics is not None:
+                    # Time spent in the bulk writes, which overlaps with the scan in pipeline mode
+                    metrics.add('bulk_write', committer.write_seconds, committer.replaced_count + committer.failed_count)
+                replacement_count = committer.replaced_count
+                failed_count = committer.failed_count
+                conflict_count = committer.conflict_count
+                batch_count = committer.batch_count
+                backoff_count = committer.throttle.backoff_count if committer.throttle is not None else 0
+            save_checkpoint(get_checkpoint(), finished=True)
+            if args['manifest']:
+                save_manifest(args['manifest'], {argument: args[argument] for argument in manifest_arguments}, high_water_mark, fingerprints)
+        else:
+            partitions = partition_filters(client[mongodb_db][mongodb_collection], filter, args['workers'], args['partition'])
+            if debug:
+                print('Scanning ' + str(len(partitions)) + ' partitions: ' + str(partitions))
+            with tempfile.TemporaryDirectory(prefix=init_time, dir='.') as partial_dir:
+                partial_paths = [os.path.join(partial_dir, 'partition' + str(i)) for i in range(len(partitions))]
+                # The workers are spawned rather than forked, as the process may have other threads running (the ones of
+                # the client and of the other collections migrated at the same time) and a forked worker could deadlock
+                # on a lock held by one of them
+                with ProcessPoolExecutor(max_workers=len(partitions), mp_context=multiprocessing.get_context('spawn')) as executor, metrics.measure('scan') if metrics is not None else nullcontext():
+                    partition_results = list(executor.map(scan_partition, [args] * len(partitions), [filter] * len(partitions), range(len(partitions)), partitions, partial_paths))
+                for result in partition_results:
+                    registry.add_usage(result['translation_usage'])
+                    replacement_count += result['replaced_count']
+                    failed_count += result['failed_count']
+                    conflict_count += result['conflict_count']
+                    batch_count += result['batch_count']
+                    backoff_count += result['backoff_count']
+
+                # Merge the partial files by _id, numbering the expressions as a serial execution would do
+                with metrics.measure('merge') if metrics is not None else nullcontext():
+                    for key, found, backup, replaced in heapq.merge(*[read_partial_file(path) for path in partial_paths], key=lambda line: line[0]):
+                        backup_writer.write_rendered(base64.b64decode(backup) if args['backupformat'] == 'bson' else backup)
+                        for found_occurrence in found:
+                            found_occurrence['expressionIndex'] = registry.intern(found_occurrence['expression'])
+                            add_occurrence(found_occurrence)
+                        replaced_writer.write_rendered(replaced)
+                        flush_writers()
+                if metrics is not None:
+                    metrics.phases['scan']['documents'] = backup_writer.count
+                    metrics.phases['merge']['documents'] = backup_writer.count
+    finally:
+        # Close the output files, also if the execution is interrupted, so the results written so far are kept
+        for writer in writers:
+            writer.close()
+
+    return results(backup_writer.count, occurrences_writer.count)
+
+
+# Print the counts of the results of migrate_collection (or of several collections together), writing the list of
+# legacy expressions found and the translation report
+def report_results(results, args):
+    init_time = results['file_prefix']
+    registry = results['registry']
+
+    # Print the counts
+    print ('\nFound ' + str(results['occurrence_count']) + ' legacy expressions in ' + str(results['document_count']) + ' documents')
+    if args['commit']:
+        print ('Updated ' + str(results['replacement_count']) + ' documents in the database')
+        if results['conflict_count'] > 0:
+            print ('Found ' + str(results['conflict_count']) + ' updates of documents that changed in the database meanwhile (retried if possible)')
+        if results['failed_count'] > 0:
+            print ('Failed to update ' + str(results['failed_count']) + ' documents in ' + str(results['batch_count']) + ' batches')
+
+    # write the list of legacy expressions found (it is always a json file, so it can be used to build the translation file)
+    f2 = open(init_time+"legacy_expressions_list.json", "w")
+    f2.write(json.dumps(registry.expressions,indent=4))
+    f2.close()
+
+    # Report the translations that could not be used, to help maintaining the translation file
+    if registry.translation_loaded:
+        unused_translations = registry.unused_translations()
+        if unused_translations != [] or registry.duplicated_translations != []:
+            print ('Translation file has ' + str(len(unused_translations)) + ' unused and ' + str(len(registry.duplicated_translations)) + ' duplicated legacy expressions (see ' + init_time + 'translation_report.json)')
+        f5 = open(init_time+"translation_report.json", "w")
+        f5.write(json.dumps({'unused': unused_translations, 'duplicated': registry.duplicated_translations},indent=4))
+        f5.close()
+
+    metrics = results.get('metrics')
+    if args['statistics']:
+        with metrics.measure('statistics') if metrics is not None else nullcontext():
+            print_statistics(statistics_rows(results['statistics_counts']), args['statistics'])
+
+    # Write the metrics report, once all the phases are done
+    if metrics is not None:
+        counts = {
+            'documents': results['document_count'],
+            'occurrences': results['occurrence_count'],
+            'updated': results['replacement_count'],
+            'conflicts': results['conflict_count'],
+            'failed': results['failed_count']
+        }
+        with open(init_time + 'metrics.json', 'w') as f:
+            json.dump(metrics.report(counts), f, indent=4)
+        print('Metrics written to ' + init_time + 'metrics.json')
+
+
+# Create the CLI arguments parser
+def create_parser():
+    parser = argparse.ArgumentParser(description='Tool to migrate legacy expressions in IoT Agents')
+    parser.add_argument('--database', help='Database names or glob patterns', required=True, nargs='+')
+    parser.add_argument('--collection', help='Collection names or glob patterns (in each database)', required=True, nargs='+')
+    parser.add_argument('--concurrency', help='Number of collections migrated at the same time', required=False, type=int, default=4)
+    parser.add_argument('--translation', help='Translation file', required=False)
+    parser.add_argument('--debug', help='Debug mode', required=False, action='store_true')
+    parser.add_argument('--commit', help='Commit changes to database', required=False, action='store_true')
+    parser.add_argument('--batchsize', help='Number of documents sent to the database in each bulk write in commit mode', required=False, type=int, default=500)
+    parser.add_argument('--pipeline', help='Send the next commit batch while the previous one is being written', required=False, action='store_true')
+    parser.add_argument('--maxrate', help='Maximum number of documents per second written to the database in commit mode', required=False, type=float)
+    parser.add_argument('--maxlatency', help='Write latency of a commit batch (in milliseconds) over which the commit slows down', required=False, type=float)
+    parser.add_argument('--maxlag', help='Replication lag (in seconds) over which the commit slows down', required=False, type=float)
+    parser.add_argument('--progressinterval', help='Seconds between the progress lines', required=False, type=float, default=10)
+    parser.add_argument('--progress', help='Print the progress of the scan every progress interval, counting the documents first to show the ETA', required=False, action='store_true')
+    parser.add_argument('--metrics', help='Write a report with the time of each phase, the peak memory and the query plan', required=False, action='store_true')
+    parser.add_argument('--resume', help='Checkpoint file of a previous execution to resume', required=False)
+    parser.add_argument('--manifest', help='Manifest file with the fingerprints of the documents, to process only the ones new or changed since the previous execution', required=False)
+    parser.add_argument('--workers', help='Number of worker processes scanning the collection in parallel', required=False, type=int, default=1)
+    parser.add_argument('--partition', help='How to split the collection between workers. Possible values: id service', required=False, choices=['id', 'service'], default='id')
+    parser.add_argument('--discovery', help='How to find the legacy expressions. Possible values: documents projection aggregation', required=False, choices=['documents', 'projection', 'aggregation'], default='documents')
+    parser.add_argument('--mongouri', help='Database connection URI', required=False, default='mongodb://localhost:27017/')
+    parser.add_argument('--expressionlanguage', help='How to handle expressionLanguage values. Can be: delete, ignore, jexl or jexlall', required=False, default='ignore')
+    parser.add_argument('--outputformat', help='Format of the output files. Possible values: json ndjson', required=False, choices=['json', 'ndjson'], default='json')
+    parser.add_argument('--backupformat', help='Format of the backup file. Possible values: json (same as the output files) bson', required=False, choices=['json', 'bson'], default='json')
+    parser.add_argument('--compress', help='Compress the output files with gzip', required=False, action='store_true')
+    parser.add_argument('--restore', help='Backup file whose documents are restored into the collection (only compared with it without --commit)', required=False)
+    parser.add_argument('--statistics', help='Show statistics at the end of the execution. Possible values: service subservice', required=False, default='service')
+    parser.add_argument('--regexservice', help='FIWARE service filter', required=False, default='.*')
+    parser.add_argument('--regexservicepath', help='FIWARE servicepath filter', required=False, default='.*')
+    parser.add_argument('--regexdeviceid', help='Device ID filter', required=False, default='.*')
+    parser.add_argument('--regexentitytype', help='Entity type filter', required=False, default='.*')
+    parser.add_argument('--service', help='FIWARE service filter', required=False)
+    parser.add_argument('--servicepath', help='FIWARE servicepath filter', required=False)
+    parser.add_argument('--deviceid', help='Device ID filter', required=False, default='')
+    parser.add_argument('--entitytype', help='Entity type filter', required=False)
+    return parser
+
+
+# Run the tool with the CLI arguments (argv, or the ones of the command line if not given). A client can be given to reuse
+# its connections instead of connecting to --mongouri. Errors are raised as MigrationError
+def main(argv=None, client=None):
+    debug = False
+    commit = False
+    registry = ExpressionRegistry()
+
+    # Init time
+    now = datetime.now()
+    init_time = now.strftime("%Y%m%dT%H%M%S_")
+
+    args = vars(create_parser().parse_args(argv))
+
+
+    if args['debug']:
+        debug = True
+
+    if args['commit'] == True:
+        print('INFO: Running the script in commit mode, this will update the database')
+        commit = True
+
+    if args['translation'] != None and args['translation'] != '':
+        try:
+            registry.load_translation(args['translation'])
+        except ValueError as e:
+            raise MigrationError('Invalid translation file: ' + str(e))
+        if registry.duplicated_translations != []:
+            print('WARNING: ' + str(len(registry.duplicated_translations)) + ' legacy expressions are duplicated in the translation file, using the first translation of each one')
+    elif (args['translation'] == None or args['translation'] == '') and commit == True and not args['restore']:
+        raise MigrationError('Translation file is required in commit mode')
+
+    if args['batchsize'] < 1:
+        raise MigrationError('Batch size must be a positive number')
+
+    if args['workers'] < 1:
+        raise MigrationError('Number of workers must be a positive number')
+
+    if any(args[argument] is not None and args[argument] <= 0 for argument in ['maxrate', 'maxlatency', 'maxlag']):
+        raise MigrationError('Maximum rate, latency and replication lag must be positive numbers')
+
+    if args['discovery'] != 'documents' and commit:
+        raise MigrationError('Discovery mode ' + args['discovery'] + ' cannot be used in commit mode')
+
+    if args['discovery'] == 'aggregation' and (args['workers'] > 1 or registry.translation_loaded):
+        raise MigrationError('Discovery mode aggregation cannot be used with workers or translation file')
+
+    if args['resume'] and (args['workers'] > 1 or args['discovery'] == 'aggregation'):
+        raise MigrationError('Resume cannot be used with workers or discovery mode aggregation')
+
+    if args['restore'] and (args['resume'] or args['workers'] > 1 or args['discovery'] != 'documents'):
+        raise MigrationError('Restore cannot be used with resume, workers or other discovery modes')
+
+    if args['manifest'] and (args['resume'] or args['restore'] or args['workers'] > 1 or args['discovery'] != 'documents'):
+        raise MigrationError('Manifest cannot be used with resume, restore, workers or other discovery modes')
+
+    if args['concurrency'] < 1:
+        raise MigrationError('Concurrency must be a positive number')
+
+    if args['expressionlanguage'] in ['delete', 'jexlall', 'jexl']:
+        expressionlanguage = args['expressionlanguage']
+    else:
+        expressionlanguage = 'ignore'
+    args['expressionlanguage'] = expressionlanguage
+
+    filter = build_filter(args, debug)
+
+    # Create a client instance of the MongoClient class, shared by all the collections
+    if client is None:
+        if debug:
+            print('Connected to: '+str(args['mongouri']))
+        client = MongoClient(args['mongouri']) # Create a client instance of the MongoClient class
+
+    if debug:
+        print('Running in debug mode')
+        print('MongoDB Query: ' + str(filter))
+
+    targets = expand_targets(client, args['database'], args['collection'])
+    if targets == []:
+        raise MigrationError('No collection matches the databases and collections given')
+    if len(targets) > 1 and (args['resume'] or args['restore'] or args['manifest']):
+        raise MigrationError('Resume, restore and manifest can only be used with a single database and collection')
+    if debug and len(targets) > 1:
+        print('Collections: ' + ', '.join(database + '.' + collection for database, collection in targets))
+
+    # Restore the documents of a backup file, instead of looking for legacy expressions
+    if args['restore']:
+        mongodb_db, mongodb_collection = targets[0]
+        restore_args = dict(args, database=mongodb_db, collection=mongodb_collection)
+        document_count, identical, different, missing = restore_backup(client[mongodb_db][mongodb_collection], args['restore'], args['batchsize'], commit, args['pipeline'], debug,
+                                                                       write_throttle(restore_args, client) if commit else None, ProgressReporter('Restore', interval=args['progressinterval']))
+        if commit:
+            print ('\nRestored ' + str(document_count) + ' documents from ' + args['restore'] + ', ' + str(identical) + ' verified')
+            if different + missing > 0:
+                raise MigrationError(str(different + missing) + ' documents differ from the backup after restoring them')
+        else:
+            print ('\nFound ' + str(document_count) + ' documents in ' + args['restore'] + ': ' + str(identical) + ' identical in the database, ' + str(different) + ' different and ' + str(missing) + ' missing (use --commit to restore them)')
+        return
+
+    if len(targets) == 1:
+        mongodb_db, mongodb_collection = targets[0]
+        result = migrate_collection(dict(args, database=mongodb_db, collection=mongodb_collection), client, registry, filter, init_time)
+        if result is not None:
+            report_results(result, args)
+        return
+
+    # Several collections are migrated at the same time in threads, sharing the client (and so its connection pool).
+    # Each one has its own output files, prefixed with its database and collection, and the maximum rate of the commit is
+    # shared between the ones migrated at the same time
+    concurrency = min(args['concurrency'], len(targets))
+    failed_targets = []
+    results = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = []
+        for mongodb_db, mongodb_collection in targets:
+            target = mongodb_db + '.' + mongodb_collection
+            target_args = dict(args, database=mongodb_db, collection=mongodb_collection, maxrate=args['maxrate'] / concurrency if args['maxrate'] is not None else None)
+            futures.append((target, executor.submit(migrate_collection, target_args, client, registry.copy_translations(), filter, init_time + target + '_', target + ' commit')))
+        for target, future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print('ERROR: Migration of ' + target + ' failed: ' + str(e))
+                failed_targets.append(target)
+
+    # Results of each collection and of all of them together
+    total = {
+        'file_prefix': init_time,
+        'registry': registry.copy_translations(),
+        'statistics_counts': Counter()
+    }
+    for count in ['document_count', 'occurrence_count', 'replacement_count', 'conflict_count', 'failed_count', 'batch_count', 'backoff_count']:
+        total[count] = sum(result[count] for result in results)
+    for result in results:
+        print('\nResults of ' + result['database'] + '.' + result['collection'] + ':')
+        report_results(result, args)
+        for expression in result['registry'].expressions:
+            total['registry'].intern(expression)
+        total['registry'].add_usage(result['registry'].translation_usage)
+        total['statistics_counts'].update(result['statistics_counts'])
+    print('\nResults of all the ' + str(len(results)) + ' collections:')
+    report_results(total, args)
+    if failed_targets != []:
+        raise MigrationError('Migration of ' + str(len(failed_targets)) + ' collections failed: ' + ', '.join(failed_targets))
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except MigrationError as e:
+        print('ERROR: ' + str(e))
+        sys.exit(1)